@@ -0,0 +1,98 @@
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from pipeline import make_options, DEFAULT_READS_PER_MINUTE, DEFAULT_WRITES_PER_MINUTE
+
+DEFAULT_PROCESSES = 4
+DEFAULT_RESULTS_FILE = 'batch_results.jsonl'
+
+# Read a batch manifest.
+# The manifest is a JSON object with a "jobs" list; each job is a config like
+# config.json plus a "name", and "defaults" holds settings shared by every job.
+# The top-level reads_per_minute and writes_per_minute are the budget shared by
+# all jobs. Jobs without their own state_file get one named after the job so
+# incremental jobs never overwrite each other's state.
+# Returns (jobs, reads_per_minute, writes_per_minute) with jobs as
+# (name, options) pairs.
+def load_manifest(path):
+    with open(path) as f:
+        manifest = json.load(f)
+    defaults = manifest.get('defaults', {})
+    jobs = []
+    names = set()
+    for index, job in enumerate(manifest['jobs']):
+        job = dict(job)
+        name = str(job.pop('name', index))
+        if name in names:
+            raise ValueError(f"Duplicate job name in {path}: {name}")
+        names.add(name)
+        options = make_options(dict(defaults, **job), f'{path} job {name}')
+        if 'state_file' not in job and 'state_file' not in defaults:
+            options['state_file'] = f'combine_state_{name}.json'
+        # The per-minute quota is the manifest's, not the job's
+        options.pop('reads_per_minute')
+        options.pop('writes_per_minute')
+        jobs.append((name, options))
+    return (jobs, manifest.get('reads_per_minute', DEFAULT_READS_PER_MINUTE),
+            manifest.get('writes_per_minute', DEFAULT_WRITES_PER_MINUTE))
+
+# Helper function to set up a worker process with the shared request budget
+def _init_worker(buckets):
+    from scheduler import configure_scheduler
+    configure_scheduler(buckets=buckets)
+
+# Helper function to run one job in a worker process and return its record.
+# Errors are turned into strings so the record always pickles and serializes.
+def _run_job(name, options):
+    from pipeline import combine
+
+    def log(message):
+        print(f"[{name}] {message}", flush=True)
+
+    start = time.perf_counter()
+    try:
+        result = combine(log=log, **options)
+    except Exception as e:
+        return {
+            'name': name,
+            'status': 'error',
+            'error': f'{type(e).__name__}: {e}',
+            'seconds': round(time.perf_counter() - start, 3)
+        }
+    return {
+        'name': name,
+        'status': 'ok',
+        'spreadsheet_id': result['spreadsheet_id'],
+        'url': result['url'],
+        'mode': result['mode'],
+        'source_errors': [[url, str(error)] for url, error in result['errors']],
+        'seconds': round(time.perf_counter() - start, 3)
+    }
+
+# Run combine jobs on a pool of processes sharing one API quota.
+# Every worker's scheduler draws from the same shared read and write buckets, so
+# the whole batch stays within reads_per_minute and writes_per_minute however
+# many processes run. One record per job is appended to results_file as a JSON
+# line as soon as the job finishes, and the records are returned in job order.
+def run_batch(jobs, processes=DEFAULT_PROCESSES, reads_per_minute=DEFAULT_READS_PER_MINUTE,
+              writes_per_minute=DEFAULT_WRITES_PER_MINUTE, results_file=DEFAULT_RESULTS_FILE):
+    from scheduler import shared_buckets
+
+    buckets = shared_buckets(reads_per_minute, writes_per_minute)
+    records = {}
+    with open(results_file, 'a') as results, ProcessPoolExecutor(
+            max_workers=max(1, min(processes, len(jobs))), initializer=_init_worker, initargs=(buckets,)) as executor:
+        futures = {executor.submit(_run_job, name, options): name for name, options in jobs}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                record = future.result()
+            except Exception as e:
+                # The worker process itself died
+                record = {'name': name, 'status': 'error', 'error': f'{type(e).__name__}: {e}'}
+            records[name] = record
+            results.write(json.dumps(record) + '\n')
+            results.flush()
+            print(f"[{name}] {record['status']}: {record.get('url') or record.get('error')}", flush=True)
+    return [records[name] for name, options in jobs]
@@ -0,0 +1,282 @@
+import argparse
+import json
+import statistics
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from fake_google import FakeGoogle, fake_services
+from pipeline import DEFAULT_REQUIRED_COLUMNS, DEFAULT_MAX_WORKERS, DEFAULT_CHUNK_ROWS, DEFAULT_MAX_IN_FLIGHT
+
+# Offline benchmarks of the combine pipeline against the in-process fake
+# Sheets/Drive backend in fake_google. Each scenario builds synthetic sources
+# and a template, then measures every pipeline stage on its own followed by a
+# full combine() and a row-level sync of the result, recording wall time, API
+# calls, bytes sent and received and peak Python memory. Run
+#     python benchmarks.py --rows 1000,20000 --latency 0.05 --json results.json
+# and pass --baseline results.json on a later run to flag regressions.
+
+# Share of rows changed in the sources before the sync benchmark
+SYNC_CHANGE_RATE = 0.01
+
+# Wall time changes smaller than this are treated as noise when comparing with a baseline
+MIN_TIME_REGRESSION = 0.05
+
+# Build the rows of a synthetic source tab.
+# The required columns are spread between filler columns up to width, every
+# link_every-th row has a link in App Promotion, and some rows are ragged
+# because the API drops trailing empty cells.
+def synthetic_rows(source, rows, width, required_columns=DEFAULT_REQUIRED_COLUMNS, link_every=10):
+    width = max(width, len(required_columns))
+    step = width / len(required_columns)
+    positions = {int(i * step): column for i, column in enumerate(required_columns)}
+    header = [positions.get(i, f'Extra {i}') for i in range(width)]
+
+    data = []
+    for row in range(rows):
+        values = []
+        for column in header:
+            if column == 'Due Date' or column == 'Live Date':
+                # Unformatted date cells come back as serial numbers
+                values.append(45292 + row % 365)
+            elif column == 'App Promotion' and row % link_every == 0:
+                values.append(f'https://example.com/{source}/{row}')
+            else:
+                values.append(f'{column} {source}-{row}')
+        if row % 7 == 3:
+            values[-1] = ''
+        data.append(values)
+    return [header] + data
+
+# Build template rowData with a bold colored header and banded rows
+def synthetic_template(rows, columns):
+    header = {'userEnteredFormat': {'backgroundColor': {'red': 0.2, 'green': 0.4, 'blue': 0.8},
+                                    'textFormat': {'bold': True}}}
+    band = {'userEnteredFormat': {'backgroundColor': {'red': 0.95, 'green': 0.95, 'blue': 0.95}}}
+    row_data = [{'values': [header] * columns}]
+    for row in range(1, rows):
+        row_data.append({'values': [band if row % 2 else {}] * columns})
+    return row_data
+
+# Fill a backend with sources spreadsheets of one tab each and a template
+def populate(backend, sources, rows, width, template_rows, template_columns):
+    urls = []
+    for source in range(sources):
+        spreadsheet_id = f'fake-source-{source}'
+        backend.add_spreadsheet(spreadsheet_id, {0: ('Data', synthetic_rows(source, rows, width))})
+        urls.append((f'https://docs.google.com/spreadsheets/d/{spreadsheet_id}/edit#gid=0', 0))
+    backend.add_spreadsheet('fake-template', {0: ('Sheet1', [], synthetic_template(template_rows, template_columns))})
+    return urls
+
+# Helper function to route clients through the fake services while combine() runs
+@contextmanager
+def _fake_clients(sheets, drive):
+    import clients
+    saved = clients.get_sheets_service, clients.get_drive_service
+    clients.get_sheets_service = lambda service_account_file=None: sheets
+    clients.get_drive_service = lambda service_account_file=None: drive
+    try:
+        yield
+    finally:
+        clients.get_sheets_service, clients.get_drive_service = saved
+
+# Helper function to run one stage and measure it.
+# API numbers are taken from the calls the backend recorded while it ran.
+def _measure(backend, function, memory=True):
+    import combiner
+    # Forget cached tab titles so every run pays for its metadata lookups
+    combiner._sheet_titles.clear()
+
+    first_call = len(backend.calls)
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = function()
+    finally:
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if memory else None
+        if memory:
+            tracemalloc.stop()
+    calls = backend.calls[first_call:]
+    return result, {
+        'seconds': seconds,
+        'calls': len(calls),
+        'retries': sum(1 for call in calls if call['status'] == 429),
+        'request_bytes': sum(call['request_bytes'] for call in calls),
+        'response_bytes': sum(call['response_bytes'] for call in calls),
+        'peak_memory': peak
+    }
+
+# Run every stage of one scenario once and return {stage: measurement}
+def run_scenario_once(backend, urls, options, memory=True):
+    from scheduler import execute
+    from combiner import (fetch_sheets, combine_dataframes, upload_dataframe, get_template_formatting,
+                          compile_hyperlinks)
+    from normalize import normalize_frame, compile_date_formats
+    from pipeline import combine
+
+    sheets, drive = fake_services(backend)
+    columns = DEFAULT_REQUIRED_COLUMNS
+    stages = {}
+
+    results, stages['fetch'] = _measure(backend, lambda: fetch_sheets(
+        sheets, urls, columns, options['max_workers']), memory)
+    combined_df, stages['merge'] = _measure(
+        backend, lambda: combine_dataframes([df for url, df, error in results if df is not None]), memory)
+    combined_df, stages['normalize'] = _measure(backend, lambda: normalize_frame(combined_df), memory)
+    created, stages['create'] = _measure(backend, lambda: execute(sheets.spreadsheets().create(body={
+        'properties': {'title': 'Benchmark'},
+        'sheets': [{'properties': {'sheetId': 0, 'title': 'Sheet1', 'gridProperties': {
+            'rowCount': len(combined_df) + 1, 'columnCount': max(26, len(combined_df.columns))}}}]
+    })), memory)
+    spreadsheet_id = created['spreadsheetId']
+    _, stages['upload'] = _measure(backend, lambda: upload_dataframe(
+        sheets, spreadsheet_id, combined_df, 'Sheet1', options['chunk_rows'], options['max_in_flight']), memory)
+    template_requests, stages['template'] = _measure(
+        backend, lambda: get_template_formatting(sheets, 'fake-template', 0), memory)
+
+    def apply_formatting():
+        requests = template_requests + compile_date_formats(combined_df, 0) + compile_hyperlinks(combined_df, columns, 0)
+        execute(sheets.spreadsheets().batchUpdate(spreadsheetId=spreadsheet_id, body={'requests': requests}))
+    _, stages['format'] = _measure(backend, apply_formatting, memory)
+    _, stages['share'] = _measure(backend, lambda: execute(drive.permissions().create(
+        fileId=spreadsheet_id, body={'type': 'anyone', 'role': 'reader'})), memory)
+    backend.spreadsheets.pop(spreadsheet_id)
+
+    with _fake_clients(sheets, drive):
+        combine_options = dict(required_columns=columns, template_sheet_id='fake-template', template_cache=None,
+                               max_workers=options['max_workers'], chunk_rows=options['chunk_rows'],
+                               max_in_flight=options['max_in_flight'], log=lambda message: None)
+        result, stages['combine'] = _measure(backend, lambda: combine(urls, **combine_options), memory)
+
+        # Change a few rows in every source, sync the combined sheet in place,
+        # then restore the sources so every run sees the same data
+        changed = []
+        for spreadsheet_id in [url.split('/d/')[1].split('/')[0] for url, gid in urls]:
+            rows = backend.spreadsheets[spreadsheet_id]['sheets'][0]['rows']
+            status = rows[0].index('Status')
+            for row in rows[1::max(1, int(1 / SYNC_CHANGE_RATE))]:
+                changed.append((row, status, row[status]))
+                row[status] = 'Changed'
+            backend.touch(spreadsheet_id)
+        _, stages['sync'] = _measure(backend, lambda: combine(
+            urls, output_spreadsheet_id=result['spreadsheet_id'], row_key=['Video topic', 'Due Date'], **combine_options), memory)
+        for row, status, value in changed:
+            row[status] = value
+    backend.spreadsheets.pop(result['spreadsheet_id'])
+    return stages
+
+# Run a scenario repeat times on a fresh backend and summarize each stage.
+# Wall time is the median over the repeats; the other numbers come from the last one.
+def run_scenario(sources, rows, width, template_rows=100, template_columns=7, latency=0.0, jitter=0.0,
+                 error_rate=0.0, repeat=3, memory=True, max_workers=DEFAULT_MAX_WORKERS, chunk_rows=DEFAULT_CHUNK_ROWS,
+                 max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+    backend = FakeGoogle(latency, jitter, error_rate)
+    urls = populate(backend, sources, rows, width, template_rows, template_columns)
+    options = {'max_workers': max_workers, 'chunk_rows': chunk_rows, 'max_in_flight': max_in_flight}
+    runs = [run_scenario_once(backend, urls, options, memory) for _ in range(repeat)]
+
+    summary = {}
+    for stage in runs[-1]:
+        summary[stage] = dict(runs[-1][stage], seconds=statistics.median(run[stage]['seconds'] for run in runs))
+    return {
+        'scenario': {'sources': sources, 'rows': rows, 'width': width, 'template_rows': template_rows,
+                     'template_columns': template_columns, 'latency': latency, 'jitter': jitter,
+                     'error_rate': error_rate, 'max_workers': max_workers, 'chunk_rows': chunk_rows,
+                     'max_in_flight': max_in_flight},
+        'stages': summary
+    }
+
+# Helper function to name a scenario in reports and baselines
+def scenario_name(scenario):
+    return f"{scenario['sources']}x{scenario['rows']} rows, {scenario['width']} cols, {scenario['latency'] * 1000:.0f}ms"
+
+# Print one scenario's stages as a table
+def print_report(report):
+    print(scenario_name(report['scenario']))
+    print(f"  {'stage':<10}{'seconds':>10}{'calls':>8}{'retries':>9}{'sent KB':>10}{'recv KB':>10}{'peak MB':>10}")
+    for stage, numbers in report['stages'].items():
+        peak = f"{numbers['peak_memory'] / 1024 / 1024:.1f}" if numbers['peak_memory'] is not None else '-'
+        print(f"  {stage:<10}{numbers['seconds']:>10.3f}{numbers['calls']:>8}{numbers['retries']:>9}"
+              f"{numbers['request_bytes'] / 1024:>10.1f}{numbers['response_bytes'] / 1024:>10.1f}{peak:>10}")
+
+# Compare reports with a baseline file from an earlier --json run.
+# A stage regresses when it makes more API calls or sends more bytes, or when
+# its wall time grows by more than tolerance (and MIN_TIME_REGRESSION).
+# Returns the regression messages.
+def compare(reports, baseline_reports, tolerance=0.2):
+    baseline = {scenario_name(report['scenario']): report['stages'] for report in baseline_reports}
+    regressions = []
+    for report in reports:
+        name = scenario_name(report['scenario'])
+        for stage, numbers in report['stages'].items():
+            before = baseline.get(name, {}).get(stage)
+            if before is None:
+                continue
+            if numbers['calls'] > before['calls']:
+                regressions.append(f"{name} {stage}: {before['calls']} -> {numbers['calls']} API calls")
+            if numbers['request_bytes'] > before['request_bytes']:
+                regressions.append(f"{name} {stage}: {before['request_bytes']} -> {numbers['request_bytes']} bytes sent")
+            if (numbers['seconds'] > before['seconds'] * (1 + tolerance)
+                    and numbers['seconds'] - before['seconds'] > MIN_TIME_REGRESSION):
+                regressions.append(f"{name} {stage}: {before['seconds']:.3f}s -> {numbers['seconds']:.3f}s")
+    return regressions
+
+# Helper function to parse a comma separated list of integers
+def _int_list(value):
+    return [int(item) for item in value.split(',')]
+
+# Command line entry point
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the combine pipeline against a fake Google backend.")
+    parser.add_argument('--sources', type=_int_list, default=[4], help="source sheets, comma separated for several runs (default: 4)")
+    parser.add_argument('--rows', type=_int_list, default=[1000, 10000], help="rows per source (default: 1000,10000)")
+    parser.add_argument('--width', type=_int_list, default=[20], help="columns per source (default: 20)")
+    parser.add_argument('--template-rows', type=int, default=100, help="formatted template rows (default: 100)")
+    parser.add_argument('--template-columns', type=int, default=7, help="formatted template columns (default: 7)")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every API call (default: 0)")
+    parser.add_argument('--jitter', type=float, default=0.0, help="random extra seconds per API call (default: 0)")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of calls answered with a 429 (default: 0)")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per scenario; wall time is the median (default: 3)")
+    parser.add_argument('--max-workers', type=int, default=DEFAULT_MAX_WORKERS)
+    parser.add_argument('--chunk-rows', type=int, default=DEFAULT_CHUNK_ROWS)
+    parser.add_argument('--max-in-flight', type=int, default=DEFAULT_MAX_IN_FLIGHT)
+    parser.add_argument('--quota', action='store_true', help="keep the real 60 requests per minute quota")
+    parser.add_argument('--no-memory', action='store_true', help="skip tracemalloc, which slows the stages down")
+    parser.add_argument('--json', metavar='PATH', help="write the results to a JSON file")
+    parser.add_argument('--baseline', metavar='PATH', help="fail if a stage regressed against this --json file")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed wall time growth against --baseline (default: 0.2)")
+    args = parser.parse_args(argv)
+
+    from scheduler import configure_scheduler
+    if args.quota:
+        configure_scheduler()
+    else:
+        configure_scheduler(reads_per_minute=10 ** 9, writes_per_minute=10 ** 9, base_delay=0.01, max_delay=0.1)
+
+    reports = []
+    for sources in args.sources:
+        for rows in args.rows:
+            for width in args.width:
+                report = run_scenario(sources, rows, width, args.template_rows, args.template_columns, args.latency,
+                                      args.jitter, args.error_rate, args.repeat, not args.no_memory,
+                                      args.max_workers, args.chunk_rows, args.max_in_flight)
+                print_report(report)
+                reports.append(report)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(reports, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(reports, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import threading
+
+import httplib2
+import google_auth_httplib2
+from google.oauth2.service_account import Credentials
+from googleapiclient.discovery import build
+
+from pipeline import DEFAULT_SERVICE_ACCOUNT_FILE
+
+# Define the scope and the service account used for every Google API call
+SCOPES = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
+SERVICE_ACCOUNT_FILE = DEFAULT_SERVICE_ACCOUNT_FILE
+
+# Socket timeout in seconds for API connections
+HTTP_TIMEOUT = 120
+
+_lock = threading.Lock()
+_credentials = {}
+_services = {}
+_sessions = {}
+
+# Load the service account credentials once per file and reuse them
+def get_credentials(service_account_file=SERVICE_ACCOUNT_FILE):
+    with _lock:
+        credentials = _credentials.get(service_account_file)
+        if credentials is None:
+            credentials = Credentials.from_service_account_file(service_account_file, scopes=SCOPES)
+            _credentials[service_account_file] = credentials
+        return credentials
+
+# Pool of authorized HTTP sessions that stands in for a single httplib2.Http.
+# httplib2.Http is not thread-safe, so every request checks out an idle session
+# (or opens a new one when all are busy) and returns it when done. Sessions and
+# their keep-alive connections live as long as the process, so later requests,
+# runs and GUI clicks reuse them whatever thread they are made from; the pool
+# never grows past the largest number of concurrent requests.
+class SessionPool:
+    def __init__(self, credentials):
+        self.credentials = credentials
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def request(self, *args, **kwargs):
+        with self._lock:
+            http = self._idle.pop() if self._idle else None
+        if http is None:
+            http = google_auth_httplib2.AuthorizedHttp(self.credentials, http=httplib2.Http(timeout=HTTP_TIMEOUT))
+        try:
+            return http.request(*args, **kwargs)
+        finally:
+            with self._lock:
+                self._idle.append(http)
+
+# Session pool shared by every client using the credentials of service_account_file
+def get_session_pool(service_account_file=SERVICE_ACCOUNT_FILE):
+    credentials = get_credentials(service_account_file)
+    with _lock:
+        pool = _sessions.get(service_account_file)
+        if pool is None:
+            pool = _sessions[service_account_file] = SessionPool(credentials)
+        return pool
+
+# Build an API client once per process and share it between threads.
+# The discovery document comes from the copy bundled with googleapiclient, so
+# no network fetch is made, and every request is sent over a session checked
+# out of the shared SessionPool, which makes the shared client thread-safe.
+def get_service(api, version, service_account_file=SERVICE_ACCOUNT_FILE):
+    key = (api, version, service_account_file)
+    with _lock:
+        service = _services.get(key)
+    if service is not None:
+        return service
+
+    service = build(api, version, http=get_session_pool(service_account_file), static_discovery=True,
+                    cache_discovery=False)
+    with _lock:
+        return _services.setdefault(key, service)
+
+# Shared Sheets v4 client
+def get_sheets_service(service_account_file=SERVICE_ACCOUNT_FILE):
+    return get_service('sheets', 'v4', service_account_file)
+
+# Shared Drive v3 client
+def get_drive_service(service_account_file=SERVICE_ACCOUNT_FILE):
+    return get_service('drive', 'v3', service_account_file)
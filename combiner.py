@@ -0,0 +1,443 @@
+import json
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from googleapiclient.errors import HttpError
+
+from scheduler import execute
+from tracing import span, current_span
+from normalize import cell_rows
+from pipeline import DEFAULT_MAX_WORKERS, DEFAULT_CHUNK_ROWS, DEFAULT_DATE_COLUMNS
+
+# Helper function to extract spreadsheet ID from URL
+def get_spreadsheet_id(url):
+    match = re.search(r'/spreadsheets/d/([a-zA-Z0-9-_]+)', url)
+    if match:
+        return match.group(1)
+    else:
+        raise ValueError(f"Invalid URL: {url}")
+
+# Helper function to turn a zero-based column index into A1 column letters
+def column_letter(index):
+    letters = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+# Helper function to quote a tab title for use in an A1 range
+def quote_sheet_title(title):
+    return "'" + title.replace("'", "''") + "'"
+
+# Tab titles by gid, cached per spreadsheet ID for the life of the process
+_sheet_titles = {}
+_sheet_titles_lock = threading.Lock()
+
+# Helper function to map gids to tab titles for a spreadsheet.
+# Only sheets.properties is requested, and the map is cached per spreadsheet so
+# repeated lookups for the same workbook cost no extra API calls.
+def get_sheet_titles(service, spreadsheet_id, refresh=False):
+    with _sheet_titles_lock:
+        titles = _sheet_titles.get(spreadsheet_id)
+    if titles is None or refresh:
+        result = execute(service.spreadsheets().get(
+            spreadsheetId=spreadsheet_id,
+            fields='sheets.properties(sheetId,title)'
+        ))
+        titles = {s['properties']['sheetId']: s['properties']['title'] for s in result.get('sheets', [])}
+        with _sheet_titles_lock:
+            _sheet_titles[spreadsheet_id] = titles
+    return titles
+
+# Helper function to build a DataFrame from per-column value ranges
+def _columns_to_frame(value_ranges, required_columns):
+    column_values = [value_range.get('values', [[]])[0] for value_range in value_ranges]
+
+    # Trailing empty cells are omitted per column, so pad every column to the longest one
+    num_rows = max((len(values) for values in column_values), default=0)
+    return pd.DataFrame({
+        column: values + [''] * (num_rows - len(values))
+        for column, values in zip(required_columns, column_values)
+    }, columns=required_columns)
+
+# Read several tabs of one spreadsheet as DataFrames keyed by gid.
+# Only the header rows and the required columns are downloaded: one batchGet
+# reads the header row of every tab to map required_columns to column letters,
+# and one more batchGet per kind of column fetches those columns for all tabs
+# at once: date_columns unformatted, with dates as serial numbers for
+# normalize_frame, and the others as the text the sheet shows, so percentages,
+# currencies and other number formats are kept. A tab that
+# cannot be read maps to the exception instead of a DataFrame, so it does not
+# affect the other tabs. Cached tab titles are looked up again when a gid is
+# missing or the header read is rejected, as it is after a tab was renamed.
+def get_spreadsheet_data(service, spreadsheet_id, gids, required_columns, date_columns=DEFAULT_DATE_COLUMNS,
+                         refresh=False):
+    titles = get_sheet_titles(service, spreadsheet_id, refresh)
+    if not refresh and any(gid not in titles for gid in gids):
+        titles = get_sheet_titles(service, spreadsheet_id, refresh=True)
+        refresh = True
+
+    results = {}
+    tabs = []
+    for gid in dict.fromkeys(gids):
+        if gid in titles:
+            tabs.append(gid)
+        else:
+            results[gid] = KeyError(f"No tab with gid {gid} in spreadsheet {spreadsheet_id}")
+    if not tabs:
+        return results
+
+    sheet = service.spreadsheets()
+    header_ranges = [f'{quote_sheet_title(titles[gid])}!1:1' for gid in tabs]
+    try:
+        headers = execute(sheet.values().batchGet(spreadsheetId=spreadsheet_id, ranges=header_ranges))
+    except HttpError as e:
+        # A stale title is an unknown range; retry once with fresh titles
+        if refresh or e.resp.status != 400:
+            raise
+        return get_spreadsheet_data(service, spreadsheet_id, gids, required_columns, date_columns, refresh=True)
+
+    column_ranges = []
+    read_tabs = []
+    for gid, header in zip(tabs, headers.get('valueRanges', [])):
+        columns = header.get('values', [[]])[0]
+        positions = {}
+        for index, name in enumerate(columns):
+            positions.setdefault(name, index)
+        missing = [column for column in required_columns if column not in positions]
+        if missing:
+            results[gid] = KeyError(f"Columns not found in sheet {titles[gid]}: {missing}")
+            continue
+
+        quoted_title = quote_sheet_title(titles[gid])
+        for column in required_columns:
+            letter = column_letter(positions[column])
+            column_ranges.append(f'{quoted_title}!{letter}2:{letter}')
+        read_tabs.append(gid)
+
+    if read_tabs:
+        is_date = [column in date_columns for column in required_columns] * len(read_tabs)
+        value_ranges = [{}] * len(column_ranges)
+        for dates, options in [(True, {'valueRenderOption': 'UNFORMATTED_VALUE', 'dateTimeRenderOption': 'SERIAL_NUMBER'}),
+                               (False, {})]:
+            indexes = [i for i, date in enumerate(is_date) if date == dates]
+            if not indexes:
+                continue
+            data = execute(sheet.values().batchGet(spreadsheetId=spreadsheet_id, ranges=[column_ranges[i] for i in indexes],
+                                                   majorDimension='COLUMNS', **options))
+            for i, value_range in zip(indexes, data.get('valueRanges', [])):
+                value_ranges[i] = value_range
+        width = len(required_columns)
+        for n, gid in enumerate(read_tabs):
+            results[gid] = _columns_to_frame(value_ranges[n * width:(n + 1) * width], required_columns)
+
+    return results
+
+# Helper function to get sheet data as a DataFrame
+def get_sheet_data(service, spreadsheet_id, gid, required_columns, date_columns=DEFAULT_DATE_COLUMNS):
+    df = get_spreadsheet_data(service, spreadsheet_id, [gid], required_columns, date_columns)[gid]
+    if isinstance(df, Exception):
+        raise df
+    return df
+
+# Fetch all sheets on a bounded thread pool.
+# Sources are grouped by spreadsheet so each workbook is read with a single
+# metadata lookup and two or three batchGets, whatever the number of tabs. The shared
+# clients from clients.py are thread-safe, so every worker uses service. Results
+# come back in input order as (url, df, error) tuples; a failing sheet only sets its own
+# error and never cancels the others. If given, progress(url, error) is called
+# from the worker thread as each source finishes.
+def fetch_sheets(service, sheet_urls_and_gids, required_columns, max_workers=DEFAULT_MAX_WORKERS, progress=None,
+                 date_columns=DEFAULT_DATE_COLUMNS):
+    parent = current_span()
+
+    def fetch(spreadsheet_id, gids):
+        with span('Fetching spreadsheet', parent, spreadsheet=spreadsheet_id, tabs=len(gids)) as current:
+            results = get_spreadsheet_data(service, spreadsheet_id, gids, required_columns, date_columns)
+            current.set(rows=sum(len(df) for df in results.values() if not isinstance(df, Exception)))
+        return results
+
+    def source_result(future, gid):
+        df = future.result()[gid]
+        if isinstance(df, Exception):
+            raise df
+        return df
+
+    def report(spreadsheet_id, future):
+        for url, gid in groups[spreadsheet_id]:
+            try:
+                source_result(future, gid)
+                progress(url, None)
+            except Exception as e:
+                progress(url, e)
+
+    groups = {}
+    for url, gid in sheet_urls_and_gids:
+        try:
+            groups.setdefault(get_spreadsheet_id(url), []).append((url, gid))
+        except ValueError as e:
+            if progress is not None:
+                progress(url, e)
+
+    results = []
+    futures = {}
+    executor = None
+    if groups:
+        executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(groups))))
+        for spreadsheet_id, sources in groups.items():
+            future = executor.submit(fetch, spreadsheet_id, [gid for url, gid in sources])
+            if progress is not None:
+                future.add_done_callback(lambda future, spreadsheet_id=spreadsheet_id: report(spreadsheet_id, future))
+            futures[spreadsheet_id] = future
+
+    try:
+        for url, gid in sheet_urls_and_gids:
+            try:
+                results.append((url, source_result(futures[get_spreadsheet_id(url)], gid), None))
+            except Exception as e:
+                results.append((url, None, e))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return results
+
+# Merge the fetched dataframes in input order
+def combine_dataframes(dataframes):
+    combined_df = pd.concat(dataframes, ignore_index=True)
+
+    # Replace NaN values with empty strings
+    return combined_df.fillna('')
+
+# Upper bound for one upload request body; the API recommends staying under 2 MB
+MAX_CHUNK_BYTES = 2 * 1024 * 1024
+
+# JSON bytes of a cell besides its text (quotes and separator), and of a date cell
+CELL_OVERHEAD_BYTES = 4
+DATE_CELL_BYTES = 12
+
+# Helper function to estimate the JSON size of every row of a frame from the
+# length of its cell text, without building or encoding the values. Text of
+# categorical columns is measured once per category.
+def _row_bytes(df):
+    sizes = np.full(len(df), 2 + CELL_OVERHEAD_BYTES * len(df.columns), dtype=np.int64)
+    for column in df.columns:
+        series = df[column]
+        if pd.api.types.is_datetime64_any_dtype(series):
+            sizes += DATE_CELL_BYTES
+        elif isinstance(series.dtype, pd.CategoricalDtype):
+            lengths = series.cat.categories.astype(str).str.len().to_numpy(dtype=np.int64)
+            codes = series.cat.codes.to_numpy()
+            sizes += np.where(codes >= 0, lengths[codes], 0)
+        else:
+            sizes += series.astype(str).str.len().to_numpy(dtype=np.int64)
+    return sizes
+
+# Helper function to yield (sheet_row, values) chunks of a DataFrame.
+# Data row n of the frame goes to sheet row start_row + n + 1 because row 0 holds
+# the header; with header=True the header is sent in front of the first chunk.
+# A chunk holds at most chunk_rows rows and is cut short where its estimated
+# body (see _row_bytes) would pass MAX_CHUNK_BYTES. Each chunk is converted to
+# a list of cell values (see cell_rows) only when it is needed, so only one
+# chunk lives in memory at a time.
+def iter_value_chunks(df, chunk_rows=DEFAULT_CHUNK_ROWS, start_row=0, header=True):
+    header_rows = [df.columns.tolist()] if header else []
+    if df.empty:
+        if header_rows:
+            yield 0, header_rows
+        return
+    for chunk_start in range(0, len(df), chunk_rows):
+        chunk = df.iloc[chunk_start:chunk_start + chunk_rows]
+        sizes = np.cumsum(_row_bytes(chunk))
+        offset = 0
+        while offset < len(chunk):
+            budget = (sizes[offset - 1] if offset else 0) + MAX_CHUNK_BYTES
+            end = max(offset + 1, int(np.searchsorted(sizes, budget, side='right')))
+            values = cell_rows(chunk.iloc[offset:end])
+            start = chunk_start + offset
+            if start == 0 and header_rows:
+                yield 0, header_rows + values
+            else:
+                yield start_row + start + 1, values
+            offset = end
+
+# Helper function to write one chunk
+def _write_chunk(service, spreadsheet_id, sheet_title, start_row, values):
+    execute(service.spreadsheets().values().update(
+        spreadsheetId=spreadsheet_id,
+        range=f'{quote_sheet_title(sheet_title)}!A{start_row + 1}',
+        valueInputOption='RAW',
+        body={'values': values}
+    ))
+
+# Upload a DataFrame (header first) in row chunks of chunk_rows.
+# With header=False the rows are written from data row start_row onwards, which
+# is how existing combined sheets are patched.
+# With max_in_flight > 1 up to that many chunks are sent at once on a thread
+# pool. A new chunk is only built once a slot is free, so at most max_in_flight
+# chunks are in memory whatever the number of rows.
+def upload_dataframe(service, spreadsheet_id, df, sheet_title='Sheet1', chunk_rows=DEFAULT_CHUNK_ROWS, max_in_flight=1,
+                     start_row=0, header=True):
+    chunks = iter_value_chunks(df, chunk_rows, start_row, header)
+    if max_in_flight <= 1:
+        for start_row, values in chunks:
+            with span('Uploading chunk', row=start_row, rows=len(values)):
+                _write_chunk(service, spreadsheet_id, sheet_title, start_row, values)
+        return
+
+    parent = current_span()
+
+    def send(start_row, values):
+        with span('Uploading chunk', parent, row=start_row, rows=len(values)):
+            _write_chunk(service, spreadsheet_id, sheet_title, start_row, values)
+
+    in_flight = []
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        while True:
+            if len(in_flight) >= max_in_flight:
+                in_flight.pop(0).result()
+            chunk = next(chunks, None)
+            if chunk is None:
+                break
+            in_flight.append(executor.submit(send, *chunk))
+        for future in in_flight:
+            future.result()
+
+# Format fields copied from the template
+TEMPLATE_FORMAT_FIELDS = 'userEnteredFormat.backgroundColor,userEnteredFormat.textFormat'
+
+# Helper function to pull the copied format fields out of a template cell
+def _cell_format(cell):
+    user_format = cell.get('userEnteredFormat', {})
+    return {key: user_format[key] for key in ('backgroundColor', 'textFormat') if key in user_format}
+
+# Compile template rowData into range-coalesced repeatCell requests.
+# Each row is split into runs of cells sharing the same format, and runs that
+# repeat with the same columns on consecutive rows are merged into one
+# rectangle, so the request count follows the number of distinct format
+# regions instead of the number of cells. Unformatted cells are skipped because
+# the destination sheet already has the default format.
+def compile_template_formatting(template_data, sheet_id):
+    rectangles = []
+    open_rectangles = {}
+    for i, row in enumerate(template_data or []):
+        runs = []
+        for j, cell in enumerate(row.get('values', [])):
+            cell_format = _cell_format(cell)
+            key = json.dumps(cell_format, sort_keys=True) if cell_format else None
+            if runs and runs[-1][2] == key and runs[-1][1] == j:
+                runs[-1][1] = j + 1
+            else:
+                runs.append([j, j + 1, key, cell_format])
+
+        still_open = {}
+        for start, end, key, cell_format in runs:
+            if key is None:
+                continue
+            rectangle = open_rectangles.get((start, end, key))
+            if rectangle is None:
+                rectangle = {'start_row': i, 'start': start, 'end': end, 'format': cell_format}
+                rectangles.append(rectangle)
+            rectangle['end_row'] = i + 1
+            still_open[(start, end, key)] = rectangle
+        open_rectangles = still_open
+
+    return [{
+        'repeatCell': {
+            'range': {
+                'sheetId': sheet_id,
+                'startRowIndex': rectangle['start_row'],
+                'endRowIndex': rectangle['end_row'],
+                'startColumnIndex': rectangle['start'],
+                'endColumnIndex': rectangle['end']
+            },
+            'cell': {
+                'userEnteredFormat': rectangle['format']
+            },
+            'fields': TEMPLATE_FORMAT_FIELDS
+        }
+    } for rectangle in rectangles]
+
+# Read a template tab's formats and compile them for sheet_id.
+# The fields mask limits the response to the copied format fields, so cell
+# values and every other property of the template stay on the server.
+def get_template_formatting(service, template_sheet_id, sheet_id, sheet_title='Sheet1'):
+    template_sheet = execute(service.spreadsheets().get(
+        spreadsheetId=template_sheet_id,
+        ranges=[quote_sheet_title(sheet_title)],
+        includeGridData=True,
+        fields='sheets.data.rowData.values.userEnteredFormat(backgroundColor,textFormat)'
+    ))
+    # A template without any formats comes back as an empty response
+    sheets = template_sheet.get('sheets') or [{}]
+    grid = (sheets[0].get('data') or [{}])[0]
+    return compile_template_formatting(grid.get('rowData', []), sheet_id)
+
+# Helper function to find the runs of True cells in each row of a boolean matrix.
+# Returns (row, start, end) triples in row-major order.
+def find_row_runs(mask):
+    padded = np.zeros((mask.shape[0], mask.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    edges = np.diff(padded, axis=1)
+    run_rows, run_starts = np.nonzero(edges == 1)
+    _, run_ends = np.nonzero(edges == -1)
+    return list(zip(run_rows.tolist(), run_starts.tolist(), run_ends.tolist()))
+
+# Compile hyperlink requests for every cell of columns that contains 'http'.
+# Detection runs column-wise on the whole frame, then contiguous link cells in
+# a row become one multi-cell updateCells block, and blocks covering the same
+# columns on consecutive rows are stacked into a single request. start_row is
+# the data row the frame starts at in the sheet; rows instead gives the data
+# row of every frame row when they are not contiguous.
+def compile_hyperlinks(combined_df, columns, sheet_id, start_row=0, rows=None):
+    if combined_df.empty:
+        return []
+
+    text = combined_df[columns].astype(str)
+    mask = text.apply(lambda column: column.str.contains('http', regex=False)).to_numpy(dtype=bool)
+    if not mask.any():
+        return []
+    positions = (np.arange(len(combined_df)) + start_row if rows is None else np.asarray(rows)).tolist()
+
+    values = text.to_numpy()
+    blocks = []
+    for i, start, end in find_row_runs(mask):
+        row = positions[i]
+        cells = [{
+            'userEnteredValue': {
+                'stringValue': value
+            },
+            'textFormatRuns': [{
+                'startIndex': 0,
+                'format': {
+                    'link': {
+                        'uri': value
+                    }
+                }
+            }]
+        } for value in values[i, start:end]]
+
+        block = blocks[-1] if blocks else None
+        if block and block['end_row'] == row and block['start'] == start and block['end'] == end:
+            block['rows'].append({'values': cells})
+            block['end_row'] = row + 1
+        else:
+            blocks.append({'start_row': row, 'end_row': row + 1, 'start': start, 'end': end, 'rows': [{'values': cells}]})
+
+    return [{
+        'updateCells': {
+            'rows': block['rows'],
+            'fields': 'userEnteredValue,textFormatRuns',
+            'range': {
+                'sheetId': sheet_id,
+                # Row 0 holds the header
+                'startRowIndex': block['start_row'] + 1,
+                'endRowIndex': block['end_row'] + 1,
+                'startColumnIndex': block['start'],
+                'endColumnIndex': block['end']
+            }
+        }
+    } for block in blocks]
@@ -0,0 +1,348 @@
+import json
+import random
+import re
+import threading
+import time
+from urllib.parse import urlsplit, parse_qs, unquote
+
+import httplib2
+
+from combiner import column_letter
+
+# Default grid of a new tab, as in the real API
+DEFAULT_GRID_ROWS = 1000
+DEFAULT_GRID_COLUMNS = 26
+
+# Raised inside the backend to answer a request with an HTTP error
+class FakeHttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+# Helper function to turn column letters into a 0-based index
+def column_index(letters):
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - ord('A') + 1
+    return index - 1
+
+# Parse an A1 range such as 'Sheet 1'!B2:B, Sheet1!1:1 or 'T'!A5.
+# Returns (title, start_row, start_column, end_row, end_column) with 0-based
+# starts and exclusive ends; an end is None when the range is open that way.
+def parse_range(a1_range):
+    match = re.match(r"^(?:'((?:[^']|'')*)'|([^!]+?))(?:!(.*))?$", a1_range)
+    if match is None:
+        raise FakeHttpError(400, f"Unable to parse range: {a1_range}")
+    title = match.group(1).replace("''", "'") if match.group(1) is not None else match.group(2)
+    cells = match.group(3)
+    if not cells:
+        return title, 0, 0, None, None
+
+    def parse_cell(cell):
+        cell_match = re.match(r'^([A-Z]*)(\d*)$', cell)
+        if cell_match is None:
+            raise FakeHttpError(400, f"Unable to parse range: {a1_range}")
+        letters, digits = cell_match.groups()
+        return (int(digits) - 1 if digits else None), (column_index(letters) if letters else None)
+
+    start, _, end = cells.partition(':')
+    start_row, start_column = parse_cell(start)
+    if not end:
+        # A single cell, e.g. the anchor of values().update
+        return title, start_row or 0, start_column or 0, None, None
+    end_row, end_column = parse_cell(end)
+    return (title, start_row or 0, start_column or 0,
+            end_row + 1 if end_row is not None else None,
+            end_column + 1 if end_column is not None else None)
+
+# Helper function to drop trailing empty cells and rows, as the API does
+def _trim(rows):
+    rows = [list(row) for row in rows]
+    for row in rows:
+        while row and row[-1] in ('', None):
+            row.pop()
+    while rows and not rows[-1]:
+        rows.pop()
+    return rows
+
+# In-memory stand-in for the Sheets v4 and Drive v3 endpoints the pipeline uses.
+# Spreadsheets hold tabs of row lists plus optional template formats; every
+# request is recorded with its method name and the bytes sent and received.
+# latency seconds (plus up to jitter more) are slept per request outside the
+# lock, so concurrent requests overlap like real ones. error_rate answers that
+# share of requests with a 429 to exercise retries.
+class FakeGoogle:
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.spreadsheets = {}
+        self.calls = []
+        self._lock = threading.Lock()
+        self._created = 0
+
+    # Add a spreadsheet; tabs maps gid to (title, rows) or (title, rows, formats)
+    # where formats is template rowData
+    def add_spreadsheet(self, spreadsheet_id, tabs, title=None):
+        sheets = {}
+        for gid, tab in tabs.items():
+            tab_title, rows = tab[0], tab[1]
+            sheets[gid] = {
+                'title': tab_title,
+                'rows': [list(row) for row in rows],
+                'formats': tab[2] if len(tab) > 2 else [],
+                'grid_rows': max(DEFAULT_GRID_ROWS, len(rows)),
+                'grid_columns': max([DEFAULT_GRID_COLUMNS] + [len(row) for row in rows])
+            }
+        self.spreadsheets[spreadsheet_id] = {
+            'title': title or spreadsheet_id,
+            'sheets': sheets,
+            'version': 1,
+            'modified_time': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())
+        }
+
+    # Mark a spreadsheet as edited, as Drive does when its content changes
+    def touch(self, spreadsheet_id):
+        spreadsheet = self.spreadsheets[spreadsheet_id]
+        spreadsheet['version'] += 1
+        spreadsheet['modified_time'] = time.strftime('%Y-%m-%dT%H:%M:%S.', time.gmtime()) + f"{spreadsheet['version'] % 1000:03d}Z"
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls = []
+
+    # Totals of the recorded calls: count, bytes sent and received, and count per method
+    def call_stats(self):
+        with self._lock:
+            calls = list(self.calls)
+        by_method = {}
+        for call in calls:
+            by_method[call['method']] = by_method.get(call['method'], 0) + 1
+        return {
+            'calls': len(calls),
+            'request_bytes': sum(call['request_bytes'] for call in calls),
+            'response_bytes': sum(call['response_bytes'] for call in calls),
+            'by_method': by_method
+        }
+
+    def _tab(self, spreadsheet_id, title):
+        for gid, tab in self._spreadsheet(spreadsheet_id)['sheets'].items():
+            if tab['title'] == title:
+                return gid, tab
+        raise FakeHttpError(400, f"Unable to parse range: {title}")
+
+    def _spreadsheet(self, spreadsheet_id):
+        spreadsheet = self.spreadsheets.get(spreadsheet_id)
+        if spreadsheet is None:
+            raise FakeHttpError(404, f"Requested entity was not found: {spreadsheet_id}")
+        return spreadsheet
+
+    # Helper function to read a range as rows or columns
+    def _read(self, spreadsheet_id, a1_range, major_dimension='ROWS'):
+        title, start_row, start_column, end_row, end_column = parse_range(a1_range)
+        gid, tab = self._tab(spreadsheet_id, title)
+        rows = tab['rows'][start_row:end_row]
+        values = [row[start_column:end_column] for row in rows]
+        if major_dimension == 'COLUMNS':
+            width = max((len(row) for row in values), default=0)
+            values = [[row[i] if i < len(row) else '' for row in values] for i in range(width)]
+        value_range = {'range': a1_range, 'majorDimension': major_dimension}
+        values = _trim(values)
+        if values:
+            value_range['values'] = values
+        return value_range
+
+    # Helper function to write rows at an anchor, enforcing the grid size
+    def _write(self, spreadsheet_id, a1_range, values):
+        title, start_row, start_column, end_row, end_column = parse_range(a1_range)
+        gid, tab = self._tab(spreadsheet_id, title)
+        last_row = start_row + len(values)
+        last_column = start_column + max((len(row) for row in values), default=0)
+        if last_row > tab['grid_rows'] or last_column > tab['grid_columns']:
+            raise FakeHttpError(400, f"Range ({title}!{column_letter(start_column)}{start_row + 1}) exceeds grid limits. "
+                                     f"Max rows: {tab['grid_rows']}, max columns: {tab['grid_columns']}")
+        rows = tab['rows']
+        while len(rows) < last_row:
+            rows.append([])
+        for offset, row_values in enumerate(values):
+            row = rows[start_row + offset]
+            if len(row) < start_column + len(row_values):
+                row.extend([''] * (start_column + len(row_values) - len(row)))
+            row[start_column:start_column + len(row_values)] = row_values
+        self._spreadsheet(spreadsheet_id)['version'] += 1
+        return {'updatedRange': a1_range, 'updatedRows': len(values),
+                'updatedCells': sum(len(row) for row in values)}
+
+    def _clear(self, spreadsheet_id, a1_range):
+        title, start_row, start_column, end_row, end_column = parse_range(a1_range)
+        gid, tab = self._tab(spreadsheet_id, title)
+        for row in tab['rows'][start_row:end_row]:
+            stop = len(row) if end_column is None else min(end_column, len(row))
+            row[start_column:stop] = [''] * max(0, stop - start_column)
+        return {'clearedRange': a1_range}
+
+    def _sheet_properties(self, gid, tab):
+        return {
+            'sheetId': gid,
+            'title': tab['title'],
+            'gridProperties': {'rowCount': tab['grid_rows'], 'columnCount': tab['grid_columns']}
+        }
+
+    def _get_spreadsheet(self, spreadsheet_id, query):
+        spreadsheet = self._spreadsheet(spreadsheet_id)
+        include_grid = query.get('includeGridData', ['false'])[0] == 'true'
+        sheets = []
+        titles = [parse_range(a1_range)[0] for a1_range in query.get('ranges', [])]
+        for gid, tab in spreadsheet['sheets'].items():
+            if titles and tab['title'] not in titles:
+                continue
+            sheet = {'properties': self._sheet_properties(gid, tab)}
+            if include_grid:
+                sheet['data'] = [{'rowData': tab['formats']}]
+            sheets.append(sheet)
+        return {'spreadsheetId': spreadsheet_id, 'properties': {'title': spreadsheet['title']}, 'sheets': sheets}
+
+    def _create(self, body):
+        self._created += 1
+        spreadsheet_id = f'fake-output-{self._created:06d}'
+        tabs = {}
+        for index, sheet in enumerate(body.get('sheets') or [{'properties': {}}]):
+            properties = sheet.get('properties', {})
+            tabs[properties.get('sheetId', index)] = (properties.get('title', f'Sheet{index + 1}'), [])
+        self.add_spreadsheet(spreadsheet_id, tabs, body.get('properties', {}).get('title'))
+        for sheet, tab in zip(body.get('sheets') or [], self.spreadsheets[spreadsheet_id]['sheets'].values()):
+            grid = sheet.get('properties', {}).get('gridProperties', {})
+            tab['grid_rows'] = grid.get('rowCount', DEFAULT_GRID_ROWS)
+            tab['grid_columns'] = grid.get('columnCount', DEFAULT_GRID_COLUMNS)
+        return self._get_spreadsheet(spreadsheet_id, {})
+
+    def _batch_update(self, spreadsheet_id, body):
+        sheets = self._spreadsheet(spreadsheet_id)['sheets']
+        replies = []
+        for request in body.get('requests', []):
+            kind, = request.keys()
+            value = request[kind]
+            if kind == 'repeatCell':
+                sheets[value['range']['sheetId']]
+            elif kind == 'updateCells':
+                anchor = value.get('start') or value['range']
+                tab = sheets[anchor['sheetId']]
+                row_index = anchor.get('rowIndex', anchor.get('startRowIndex', 0))
+                column_index = anchor.get('columnIndex', anchor.get('startColumnIndex', 0))
+                values = [[cell.get('userEnteredValue', {}).get('stringValue', '') for cell in row.get('values', [])]
+                          for row in value['rows']]
+                self._write(spreadsheet_id, f"'{tab['title']}'!{column_letter(column_index)}{row_index + 1}", values)
+            elif kind == 'deleteDimension':
+                dimension_range = value['range']
+                tab = sheets[dimension_range['sheetId']]
+                del tab['rows'][dimension_range['startIndex']:dimension_range['endIndex']]
+                tab['grid_rows'] -= dimension_range['endIndex'] - dimension_range['startIndex']
+            elif kind == 'appendDimension':
+                tab = sheets[value['sheetId']]
+                key = 'grid_rows' if value['dimension'] == 'ROWS' else 'grid_columns'
+                tab[key] += value['length']
+            elif kind == 'updateSheetProperties':
+                tab = sheets[value['properties']['sheetId']]
+                grid = value['properties'].get('gridProperties', {})
+                tab['grid_rows'] = grid.get('rowCount', tab['grid_rows'])
+                tab['grid_columns'] = grid.get('columnCount', tab['grid_columns'])
+            else:
+                raise FakeHttpError(400, f"Unsupported request in fake backend: {kind}")
+            replies.append({})
+        return {'spreadsheetId': spreadsheet_id, 'replies': replies}
+
+    # Route one REST call to the backend; returns (method name, status, result)
+    def handle(self, method, uri, body):
+        parts = urlsplit(uri)
+        path = unquote(parts.path)
+        query = parse_qs(parts.query)
+        payload = json.loads(body) if body and method != 'GET' else {}
+
+        routes = [
+            ('GET', r'^/v4/spreadsheets/([^/:]+)/values:batchGet$', 'sheets.values.batchGet',
+             lambda sid: {'spreadsheetId': sid, 'valueRanges': [
+                 self._read(sid, a1_range, query.get('majorDimension', ['ROWS'])[0]) for a1_range in query.get('ranges', [])]}),
+            ('POST', r'^/v4/spreadsheets/([^/:]+)/values:batchUpdate$', 'sheets.values.batchUpdate',
+             lambda sid: {'spreadsheetId': sid, 'responses': [
+                 self._write(sid, value_range['range'], value_range['values']) for value_range in payload.get('data', [])]}),
+            ('POST', r'^/v4/spreadsheets/([^/:]+)/values/(.+?):clear$', 'sheets.values.clear',
+             lambda sid, a1_range: self._clear(sid, a1_range)),
+            ('GET', r'^/v4/spreadsheets/([^/:]+)/values/(.+)$', 'sheets.values.get',
+             lambda sid, a1_range: self._read(sid, a1_range, query.get('majorDimension', ['ROWS'])[0])),
+            ('PUT', r'^/v4/spreadsheets/([^/:]+)/values/(.+)$', 'sheets.values.update',
+             lambda sid, a1_range: self._write(sid, a1_range, payload.get('values', []))),
+            ('POST', r'^/v4/spreadsheets/([^/:]+):batchUpdate$', 'sheets.batchUpdate',
+             lambda sid: self._batch_update(sid, payload)),
+            ('GET', r'^/v4/spreadsheets/([^/:]+)$', 'sheets.get',
+             lambda sid: self._get_spreadsheet(sid, query)),
+            ('POST', r'^/v4/spreadsheets$', 'sheets.create',
+             lambda: self._create(payload)),
+            ('GET', r'^/drive/v3/files/([^/]+)$', 'drive.files.get',
+             lambda fid: {'id': fid, 'modifiedTime': self._spreadsheet(fid)['modified_time'],
+                          'version': str(self._spreadsheet(fid)['version'])}),
+            ('DELETE', r'^/drive/v3/files/([^/]+)$', 'drive.files.delete',
+             lambda fid: self.spreadsheets.pop(fid, None) and None),
+            ('POST', r'^/drive/v3/files/([^/]+)/permissions$', 'drive.permissions.create',
+             lambda fid: {'id': 'anyoneWithLink', 'type': payload.get('type'), 'role': payload.get('role')}),
+        ]
+        for route_method, pattern, name, action in routes:
+            match = re.match(pattern, path)
+            if route_method == method and match:
+                if self.error_rate and self.random.random() < self.error_rate:
+                    return name, 429, {'error': {'code': 429, 'message': 'Quota exceeded (fake)'}}
+                try:
+                    with self._lock:
+                        return name, 200, action(*match.groups())
+                except FakeHttpError as e:
+                    return name, e.status, {'error': {'code': e.status, 'message': str(e)}}
+                except (KeyError, IndexError, ValueError) as e:
+                    return name, 400, {'error': {'code': 400, 'message': f'Invalid request: {e!r}'}}
+        return f'{method} {path}', 404, {'error': {'code': 404, 'message': f'No fake route for {method} {path}'}}
+
+# httplib2.Http replacement that sends every request to a FakeGoogle backend.
+# Pass it as http= to googleapiclient.discovery.build; it is safe to share
+# between threads.
+class FakeHttp:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        headers = headers or {}
+        if isinstance(body, bytes):
+            body = body.decode('utf-8')
+        sent_bytes = len(uri) + len(body or '')
+        override = {key.lower(): value for key, value in headers.items()}.get('x-http-method-override')
+        if override is not None:
+            # googleapiclient sends a GET with a very long URI as a POST carrying the query in its body
+            uri = f'{uri}?{body}'
+            method = override
+            body = None
+        name, status, result = self.backend.handle(method, uri, body)
+
+        backend = self.backend
+        if backend.latency or backend.jitter:
+            with backend._lock:
+                delay = backend.latency + backend.random.uniform(0, backend.jitter)
+            time.sleep(delay)
+
+        content = b'' if result is None else json.dumps(result).encode('utf-8')
+        with backend._lock:
+            backend.calls.append({
+                'method': name,
+                'status': status,
+                'request_bytes': sent_bytes,
+                'response_bytes': len(content),
+                'time': time.perf_counter()
+            })
+        if result is None and status == 200:
+            status = 204
+        return httplib2.Response({'status': status, 'content-type': 'application/json'}), content
+
+# Build Sheets v4 and Drive v3 clients that talk to backend
+def fake_services(backend):
+    from googleapiclient.discovery import build
+    http = FakeHttp(backend)
+    sheets = build('sheets', 'v4', http=http, static_discovery=True, cache_discovery=False)
+    drive = build('drive', 'v3', http=http, static_discovery=True, cache_discovery=False)
+    return sheets, drive
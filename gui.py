@@ -2,21 +2,23 @@ import tkinter as tk
 from tkinter import ttk
 from tkinter import messagebox
 from PIL import Image, ImageTk
-import pandas as pd
-from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
-import re
 import webbrowser
+import queue
+import threading
+from scheduler import cancel_requests, reset_cancel, CancelledError
+from pipeline import combine, DEFAULT_REQUIRED_COLUMNS
 
 class GoogleSheetsCombinerApp(tk.Tk):
     def __init__(self):
         super().__init__()
         self.title("Google Sheets Combiner")
         self.configure(bg='#2e2e2e')
-        self.geometry("600x400")
+        self.geometry("600x520")
         self.resizable(False, False)
 
         self.pages = {}
+        self.events = queue.Queue()
+        self.worker = None
         self.create_widgets()
         self.show_main_page()
 
@@ -70,19 +72,28 @@ class GoogleSheetsCombinerApp(tk.Tk):
 
         self.sheet_entries = []
 
-        execute_button = ttk.Button(input_frame, text="Execute", command=self.execute_script, style="TButton")
-        execute_button.grid(column=0, row=100, columnspan=2, pady=10)
+        self.execute_button = ttk.Button(input_frame, text="Execute", command=self.execute_script, style="TButton")
+        self.execute_button.grid(column=0, row=100, pady=10, sticky='e')
+
+        self.cancel_button = ttk.Button(input_frame, text="Cancel", state=tk.DISABLED, command=self.cancel_script, style="TButton")
+        self.cancel_button.grid(column=1, row=100, padx=10, pady=10, sticky='w')
+
+        self.progress_bar = ttk.Progressbar(input_frame, orient='horizontal', length=400, mode='determinate')
+        self.progress_bar.grid(column=0, row=101, columnspan=2, pady=5)
+
+        self.progress_label = ttk.Label(input_frame, text="", style='TLabel')
+        self.progress_label.grid(column=0, row=102, columnspan=2)
 
         self.open_link_button = ttk.Button(input_frame, text="Open Link", state=tk.DISABLED, style="TButton")
-        self.open_link_button.grid(column=0, row=101, columnspan=2, pady=10)
+        self.open_link_button.grid(column=0, row=103, columnspan=2, pady=10)
 
-        self.log_label = ttk.Label(input_frame, text="", wraplength=400, style='TLabel')
-        self.log_label.grid(column=0, row=102, columnspan=2, pady=10)
+        self.log_text = tk.Text(input_frame, height=6, width=70, state=tk.DISABLED, bg='#333333', fg='#ffffff', relief='flat')
+        self.log_text.grid(column=0, row=104, columnspan=2, padx=10, pady=5)
 
         back_button = ttk.Button(input_frame, text="Back", command=self.show_main_page, style="TButton")
-        back_button.grid(column=0, row=103, columnspan=2, pady=10)
+        back_button.grid(column=0, row=105, columnspan=2, pady=10)
 
-        for i in range(104):
+        for i in range(106):
             input_frame.grid_rowconfigure(i, weight=1)
         input_frame.grid_columnconfigure(0, weight=1)
         input_frame.grid_columnconfigure(1, weight=1)
@@ -119,184 +130,97 @@ class GoogleSheetsCombinerApp(tk.Tk):
         self.show_input_page()
 
     def execute_script(self):
-        try:
-            self.update_log("Starting execution...")
-            SCOPES = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
-            SERVICE_ACCOUNT_FILE = 'credentials.json'  # Path to your credentials.json file
-
-            self.update_log("Loading credentials...")
-            credentials = Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=SCOPES)
-
-            self.update_log("Building Google Sheets service...")
-            service = build('sheets', 'v4', credentials=credentials)
-            drive_service = build('drive', 'v3', credentials=credentials)
-
-            template_sheet_id = self.entry_template.get()
-
-            sheet_urls_and_gids = [(entry.get(), 0) for entry in self.sheet_entries]
-
-            def get_spreadsheet_id(url):
-                match = re.search(r'/spreadsheets/d/([a-zA-Z0-9-_]+)', url)
-                if match:
-                    return match.group(1)
-                else:
-                    raise ValueError(f"Invalid URL: {url}")
-
-            def get_sheet_data(spreadsheet_id, gid, required_columns):
-                sheet = service.spreadsheets()
-                result = sheet.get(spreadsheetId=spreadsheet_id).execute()
-                sheet_title = [s for s in result['sheets'] if s['properties']['sheetId'] == gid][0]['properties']['title']
-                data = sheet.values().get(spreadsheetId=spreadsheet_id, range=sheet_title).execute()
-                columns = data['values'][0]
-                values = data['values'][1:]
-
-                max_columns = len(columns)
-                for row in values:
-                    if len(row) < max_columns:
-                        row.extend([''] * (max_columns - len(row)))
-                    elif len(row) > max_columns:
-                        row = row[:max_columns]
-
-                df = pd.DataFrame(values, columns=columns)
-                df = df[required_columns]
-
-                return df
-
-            required_columns = ['Due Date', 'Video topic', 'App Promotion', 'Type', 'Thumbnail Text', 'Live Date', 'Status']
-
-            self.update_log("Reading data from all sheets...")
-            dataframes = []
-            for url, gid in sheet_urls_and_gids:
-                try:
-                    spreadsheet_id = get_spreadsheet_id(url)
-                    df = get_sheet_data(spreadsheet_id, gid, required_columns)
-                    dataframes.append(df)
-                except Exception as e:
-                    self.update_log(f"Error processing sheet: {url} - {e}")
-
-            if not dataframes:
-                self.update_log("No valid data found in any sheets.")
-                return
-
-            self.update_log("Merging dataframes...")
-            combined_df = pd.concat(dataframes, ignore_index=True)
-            combined_df = combined_df.fillna('')
-
-            self.update_log("Creating new Google Sheet...")
-            spreadsheet_body = {
-                'properties': {
-                    'title': 'Combined Sheet Based on Template'
-                },
-                'sheets': [
-                    {
-                        'properties': {
-                            'title': 'Sheet1'
-                        }
-                    }
-                ]
-            }
-            spreadsheet = service.spreadsheets().create(body=spreadsheet_body, fields='spreadsheetId,sheets').execute()
-            spreadsheet_id = spreadsheet.get('spreadsheetId')
-            new_sheet_id = spreadsheet['sheets'][0]['properties']['sheetId']
-
-            self.update_log("Uploading data to new sheet...")
-            body = {
-                'values': [combined_df.columns.values.tolist()] + combined_df.values.tolist()
-            }
-            service.spreadsheets().values().update(
-                spreadsheetId=spreadsheet_id,
-                range='Sheet1!A1',
-                valueInputOption='RAW',
-                body=body
-            ).execute()
-
-            self.update_log("Copying formatting from template sheet...")
-            template_sheet = service.spreadsheets().get(spreadsheetId=template_sheet_id, ranges=['Sheet1'], includeGridData=True).execute()
-            template_data = template_sheet['sheets'][0]['data'][0]['rowData']
-
-            if template_data:
-                requests = []
-                for i, row in enumerate(template_data):
-                    if 'values' in row:
-                        for j, cell in enumerate(row['values']):
-                            requests.append({
-                                'updateCells': {
-                                    'rows': [{
-                                        'values': [cell]
-                                    }],
-                                    'fields': 'userEnteredFormat.backgroundColor,userEnteredFormat.textFormat',
-                                    'range': {
-                                        'sheetId': new_sheet_id,
-                                        'startRowIndex': i,
-                                        'endRowIndex': i + 1,
-                                        'startColumnIndex': j,
-                                        'endColumnIndex': j + 1
-                                    }
-                                }
-                            })
-
-                if requests:
-                    service.spreadsheets().batchUpdate(
-                        spreadsheetId=spreadsheet_id,
-                        body={'requests': requests}
-                    ).execute()
-
-            self.update_log("Applying hyperlinks...")
-            requests = []
-            for i, row in combined_df.iterrows():
-                for j, col in enumerate(required_columns):
-                    if 'http' in str(row[col]):
-                        requests.append({
-                            'updateCells': {
-                                'rows': [{
-                                    'values': [{
-                                        'userEnteredValue': {
-                                            'stringValue': row[col]
-                                        },
-                                        'textFormatRuns': [{
-                                            'startIndex': 0,
-                                            'format': {
-                                                'link': {
-                                                    'uri': row[col]
-                                                }
-                                            }
-                                        }]
-                                    }]
-                                }],
-                                'fields': 'userEnteredValue,textFormatRuns',
-                                'range': {
-                                    'sheetId': new_sheet_id,
-                                    'startRowIndex': i + 1,
-                                    'endRowIndex': i + 2,
-                                    'startColumnIndex': j,
-                                    'endColumnIndex': j + 1
-                                }
-                            }
-                        })
-
-            if requests:
-                service.spreadsheets().batchUpdate(
-                    spreadsheetId=spreadsheet_id,
-                    body={'requests': requests}
-                ).execute()
-
-            self.update_log("Sharing the new sheet with anyone who has the link...")
-            drive_service.permissions().create(
-                fileId=spreadsheet_id,
-                body={'type': 'anyone', 'role': 'writer'}  # Make the sheet editable
-            ).execute()
-
-            new_sheet_url = f"https://docs.google.com/spreadsheets/d/{spreadsheet_id}/edit"
-            self.update_log(f'Data combined successfully. Access it here: {new_sheet_url}')
-
-            self.open_link_button.config(state=tk.NORMAL, command=lambda: open_link(new_sheet_url))
+        if self.worker is not None and self.worker.is_alive():
+            return
 
+        template_sheet_id = self.entry_template.get()
+        sheet_urls_and_gids = [(entry.get(), 0) for entry in self.sheet_entries]
+
+        self.clear_log()
+        self.open_link_button.config(state=tk.DISABLED)
+        self.execute_button.config(state=tk.DISABLED)
+        self.cancel_button.config(state=tk.NORMAL)
+        self.sheets_done = 0
+        self.sheets_total = len(sheet_urls_and_gids)
+        self.progress_bar.config(maximum=max(1, self.sheets_total), value=0)
+        self.progress_label.config(text=f"0/{self.sheets_total} sheets read")
+
+        # Run the pipeline off the Tk thread; it reports back through self.events
+        reset_cancel()
+        self.worker = threading.Thread(target=self.run_pipeline, args=(template_sheet_id, sheet_urls_and_gids), daemon=True)
+        self.worker.start()
+        self.after(100, self.poll_events)
+
+    def cancel_script(self):
+        self.cancel_button.config(state=tk.DISABLED)
+        self.update_log("Cancelling...")
+        cancel_requests()
+
+    def post(self, kind, *args):
+        self.events.put((kind,) + args)
+
+    def run_pipeline(self, template_sheet_id, sheet_urls_and_gids):
+        try:
+            def log(message):
+                self.post('log', message)
+
+            def sheet_done(url, error):
+                self.post('progress', url, error)
+
+            result = combine(
+                sheet_urls_and_gids,
+                DEFAULT_REQUIRED_COLUMNS,
+                template_sheet_id,
+                share_role='writer',  # Make the sheet editable
+                log=log,
+                progress=sheet_done
+            )
+
+            self.post('log', f"Data combined successfully. Access it here: {result['url']}")
+            self.post('link', result['url'])
+
+        except CancelledError:
+            self.post('log', "Execution cancelled.")
         except Exception as e:
-            self.update_log(f"Error: {str(e)}")
+            self.post('log', f"Error: {str(e)}")
+        finally:
+            self.post('finished')
+
+    def poll_events(self):
+        finished = False
+        while True:
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                break
+            kind = event[0]
+            if kind == 'log':
+                self.update_log(event[1])
+            elif kind == 'progress':
+                self.sheets_done += 1
+                self.progress_bar.config(value=self.sheets_done)
+                self.progress_label.config(text=f"{self.sheets_done}/{self.sheets_total} sheets read")
+            elif kind == 'link':
+                self.open_link_button.config(state=tk.NORMAL, command=lambda url=event[1]: open_link(url))
+            elif kind == 'finished':
+                finished = True
+
+        if finished:
+            self.execute_button.config(state=tk.NORMAL)
+            self.cancel_button.config(state=tk.DISABLED)
+        else:
+            self.after(100, self.poll_events)
+
+    def clear_log(self):
+        self.log_text.config(state=tk.NORMAL)
+        self.log_text.delete('1.0', tk.END)
+        self.log_text.config(state=tk.DISABLED)
 
     def update_log(self, message):
-        self.log_label.config(text=message)
-        self.update_idletasks()
+        self.log_text.config(state=tk.NORMAL)
+        self.log_text.insert(tk.END, message + '\n')
+        self.log_text.see(tk.END)
+        self.log_text.config(state=tk.DISABLED)
 
 def open_link(url):
     webbrowser.open(url)
@@ -0,0 +1,242 @@
+import hashlib
+import json
+import os
+
+import pandas as pd
+from googleapiclient.errors import HttpError
+
+from scheduler import execute
+from combiner import (get_spreadsheet_id, column_letter, quote_sheet_title, fetch_sheets,
+                      compile_hyperlinks, upload_dataframe, DEFAULT_MAX_WORKERS, DEFAULT_CHUNK_ROWS)
+from normalize import normalize_frame, compile_date_formats
+from pipeline import DEFAULT_DATE_COLUMNS
+
+# Bump when the layout of the state file changes so old files trigger a full rebuild
+STATE_VERSION = 2
+
+# Helper function to build the state key of a source tab
+def source_key(spreadsheet_id, gid):
+    return f'{spreadsheet_id}#{gid}'
+
+# Load the incremental state file, or None if there is no usable state
+def load_state(path):
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state.get('state_version') != STATE_VERSION:
+        return None
+    return state
+
+# Write the state file atomically so an interrupted run never leaves it half written
+def save_state(path, state):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, path)
+
+# Look up the Drive modifiedTime and version of each spreadsheet
+def get_revisions(drive_service, spreadsheet_ids):
+    revisions = {}
+    for spreadsheet_id in dict.fromkeys(spreadsheet_ids):
+        revisions[spreadsheet_id] = execute(drive_service.files().get(
+            fileId=spreadsheet_id,
+            fields='modifiedTime,version'
+        ))
+    return revisions
+
+# Helper function to tell whether the combined sheet of a state still exists
+# and is not in the trash
+def _sheet_exists(drive_service, spreadsheet_id):
+    try:
+        sheet = execute(drive_service.files().get(fileId=spreadsheet_id, fields='trashed'))
+    except HttpError as e:
+        if e.resp.status == 404:
+            return False
+        raise
+    return not sheet.get('trashed')
+
+# Content hash of a source frame, independent of its index
+def hash_frame(df):
+    digest = hashlib.sha256(json.dumps(df.columns.tolist()).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return digest.hexdigest()
+
+# Build the state for a combined sheet from the per-source results.
+# frames is aligned with sheet_urls_and_gids and holds None for sources that
+# failed; those get no revision so the next run tries them again.
+# text_date_columns are the date_columns the full run wrote as text (see
+# normalize.text_date_columns); refreshed rows are typed the same way.
+def build_state(spreadsheet_id, sheet_id, sheet_title, grid_rows, sheet_urls_and_gids, required_columns, revisions, frames,
+                date_columns=DEFAULT_DATE_COLUMNS, text_date_columns=()):
+    sources = []
+    row_start = 0
+    for (url, gid), df in zip(sheet_urls_and_gids, frames):
+        spreadsheet = get_spreadsheet_id(url)
+        revision = revisions.get(spreadsheet, {}) if df is not None else {}
+        row_count = len(df) if df is not None else 0
+        sources.append({
+            'key': source_key(spreadsheet, gid),
+            'modified_time': revision.get('modifiedTime'),
+            'version': revision.get('version'),
+            'hash': hash_frame(df) if df is not None else None,
+            'row_start': row_start,
+            'row_count': row_count
+        })
+        row_start += row_count
+    return {
+        'state_version': STATE_VERSION,
+        'spreadsheet_id': spreadsheet_id,
+        'sheet_id': sheet_id,
+        'sheet_title': sheet_title,
+        'grid_rows': grid_rows,
+        'required_columns': list(required_columns),
+        'date_columns': list(date_columns),
+        'text_date_columns': list(text_date_columns),
+        'sources': sources
+    }
+
+# Helper function to read data rows [start, end) of the combined sheet
+def _read_rows(service, state, start, end):
+    columns = state['required_columns']
+    if end <= start:
+        return pd.DataFrame([], columns=columns)
+    last_letter = column_letter(len(columns) - 1)
+    # Read the stored values, not their display text, so dates are written back as dates
+    data = execute(service.spreadsheets().values().get(
+        spreadsheetId=state['spreadsheet_id'],
+        range=f"{quote_sheet_title(state['sheet_title'])}!A{start + 2}:{last_letter}{end + 1}",
+        valueRenderOption='UNFORMATTED_VALUE',
+        dateTimeRenderOption='SERIAL_NUMBER'
+    ))
+    rows = data.get('values', [])
+    rows += [[]] * (end - start - len(rows))
+    return pd.DataFrame([row + [''] * (len(columns) - len(row)) for row in rows], columns=columns)
+
+# Refresh an existing combined sheet from the sources that changed.
+# Drive revisions are checked first and only sources whose spreadsheet has a
+# new version are downloaded; a source whose content hash is unchanged is not
+# written. A changed source that keeps its row count is rewritten in place.
+# Once a source grows or shrinks, every row after it moves, so the rest of the
+# sheet is rebuilt from the changed frames and the rows already in the sheet.
+# A source that fails to download keeps its old rows and state, so the next
+# run tries it again; its error is passed to log and returned.
+# Returns (state, changed_urls, errors) with errors as (url, error) pairs, or
+# None when the source list or columns no longer match the state, or the
+# combined sheet was deleted, and a full rebuild is needed.
+def refresh_combined_sheet(service, drive_service, state, sheet_urls_and_gids, required_columns,
+                           max_workers=DEFAULT_MAX_WORKERS, chunk_rows=DEFAULT_CHUNK_ROWS, date_columns=DEFAULT_DATE_COLUMNS,
+                           log=print):
+    try:
+        keys = [source_key(get_spreadsheet_id(url), gid) for url, gid in sheet_urls_and_gids]
+    except ValueError:
+        return None
+    if (state is None or [source['key'] for source in state['sources']] != keys
+            or state['required_columns'] != list(required_columns) or state['date_columns'] != list(date_columns)):
+        return None
+    if not _sheet_exists(drive_service, state['spreadsheet_id']):
+        return None
+
+    revisions = get_revisions(drive_service, [get_spreadsheet_id(url) for url, gid in sheet_urls_and_gids])
+    stale = []
+    for index, ((url, gid), source) in enumerate(zip(sheet_urls_and_gids, state['sources'])):
+        revision = revisions[get_spreadsheet_id(url)]
+        if source['hash'] is None or source['version'] != revision.get('version'):
+            stale.append(index)
+    if not stale:
+        return state, [], []
+
+    changed = {}
+    errors = []
+    fetched = fetch_sheets(service, [sheet_urls_and_gids[index] for index in stale], required_columns, max_workers,
+                           date_columns=date_columns)
+    for index, (url, df, error) in zip(stale, fetched):
+        if error is not None:
+            log(f"Error processing sheet: {url} - {error}")
+            errors.append((url, error))
+            continue
+        source = state['sources'][index]
+        revision = revisions[get_spreadsheet_id(url)]
+        source['modified_time'] = revision.get('modifiedTime')
+        source['version'] = revision.get('version')
+        new_hash = hash_frame(df)
+        if new_hash != source['hash']:
+            changed[index] = df
+            source['hash'] = new_hash
+    if not changed:
+        return state, [], errors
+
+    sources = state['sources']
+    old_total = sum(source['row_count'] for source in sources)
+    shift_index = next((index for index in sorted(changed) if len(changed[index]) != sources[index]['row_count']), None)
+
+    writes = []
+    for index in sorted(changed):
+        if shift_index is not None and index >= shift_index:
+            break
+        writes.append((sources[index]['row_start'], changed[index]))
+
+    if shift_index is not None:
+        tail_start = sources[shift_index]['row_start']
+        read_start = tail_start + sources[shift_index]['row_count']
+        old_tail = _read_rows(service, state, read_start, old_total)
+        blocks = []
+        for index in range(shift_index, len(sources)):
+            source = sources[index]
+            if index in changed:
+                blocks.append(changed[index])
+            else:
+                offset = source['row_start'] - read_start
+                blocks.append(old_tail.iloc[offset:offset + source['row_count']])
+        tail = pd.concat(blocks, ignore_index=True).fillna('')
+        writes.append((tail_start, tail))
+
+        row_start = tail_start
+        for index in range(shift_index, len(sources)):
+            sources[index]['row_start'] = row_start
+            sources[index]['row_count'] = len(changed[index]) if index in changed else sources[index]['row_count']
+            row_start += sources[index]['row_count']
+        new_total = row_start
+
+        # Grow the grid before writing past its end, and clear rows left over from a longer sheet
+        if new_total + 1 > state['grid_rows']:
+            execute(service.spreadsheets().batchUpdate(
+                spreadsheetId=state['spreadsheet_id'],
+                body={'requests': [{
+                    'appendDimension': {
+                        'sheetId': state['sheet_id'],
+                        'dimension': 'ROWS',
+                        'length': new_total + 1 - state['grid_rows']
+                    }
+                }]}
+            ))
+            state['grid_rows'] = new_total + 1
+        if new_total < old_total:
+            last_letter = column_letter(len(required_columns) - 1)
+            execute(service.spreadsheets().values().clear(
+                spreadsheetId=state['spreadsheet_id'],
+                range=f"{quote_sheet_title(state['sheet_title'])}!A{new_total + 2}:{last_letter}{old_total + 1}",
+                body={}
+            ))
+
+    requests = []
+    date_formats = {}
+    for start_row, df in writes:
+        # Written rows get the column types the full run gave the whole sheet
+        df = normalize_frame(df, date_columns, state['text_date_columns'])
+        upload_dataframe(service, state['spreadsheet_id'], df, state['sheet_title'], chunk_rows,
+                         start_row=start_row, header=False)
+        requests += compile_hyperlinks(df, required_columns, state['sheet_id'], start_row)
+        for request in compile_date_formats(df, state['sheet_id']):
+            date_formats[request['repeatCell']['range']['startColumnIndex']] = request
+    requests += date_formats.values()
+    if requests:
+        execute(service.spreadsheets().batchUpdate(
+            spreadsheetId=state['spreadsheet_id'],
+            body={'requests': requests}
+        ), idempotent=True)
+
+    return state, [sheet_urls_and_gids[index][0] for index in sorted(changed)], errors
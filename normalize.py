@@ -0,0 +1,132 @@
+import numpy as np
+import pandas as pd
+
+from pipeline import DEFAULT_DATE_COLUMNS
+
+# Day 0 of Google Sheets date serial numbers
+SERIAL_EPOCH = pd.Timestamp('1899-12-30')
+
+# Text columns with at most this share of distinct values become categorical
+CATEGORY_MAX_UNIQUE_RATIO = 0.5
+
+# Helper function to render one unformatted cell value as the text Sheets shows
+def _cell_text(value):
+    if value is None or value == '':
+        return ''
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+# Helper function to tell which cells of an object column hold numbers
+def _numeric_mask(series):
+    return series.map(lambda value: isinstance(value, (int, float)) and not isinstance(value, bool)).to_numpy(dtype=bool)
+
+# Helper function to convert a column of date serial numbers.
+# Returns a datetime column when every non-empty cell is a serial number;
+# otherwise the column stays text, with serials written as ISO dates, so cells
+# like "TBD" are kept. as_text always gives the text column.
+def _date_column(series, as_text=False):
+    empty = (series == '').to_numpy(dtype=bool) | series.isna().to_numpy(dtype=bool)
+    numeric = _numeric_mask(series)
+    serials = pd.to_numeric(series.where(numeric), errors='coerce')
+    dates = SERIAL_EPOCH + pd.to_timedelta(serials, unit='D')
+    if not as_text and (numeric | empty).all():
+        return dates
+    text = series.map(_cell_text)
+    text[numeric] = dates[numeric].dt.strftime('%Y-%m-%d')
+    return text.astype('string')
+
+# Helper function to convert a column to a string or categorical dtype
+def _text_column(series):
+    if pd.api.types.infer_dtype(series, skipna=True) != 'string':
+        series = series.map(_cell_text)
+    text = series.fillna('').astype('string')
+    if len(text) and text.nunique() <= CATEGORY_MAX_UNIQUE_RATIO * len(text):
+        return text.astype('category')
+    return text
+
+# Give a combined frame of unformatted cell values typed columns.
+# Date columns holding serial numbers become datetimes (empty cells are NaT);
+# every other column becomes text, stored as a categorical when its values
+# repeat a lot (Type, Status, ...) and as a string column otherwise.
+# text_date_columns are date columns kept as text even when every cell is a
+# date, so part of a sheet is typed like the rest of it (see text_date_columns).
+def normalize_frame(df, date_columns=DEFAULT_DATE_COLUMNS, text_date_columns=()):
+    return pd.DataFrame({
+        column: _date_column(df[column], column in text_date_columns) if column in date_columns
+        else _text_column(df[column])
+        for column in df.columns
+    }, columns=df.columns)
+
+# Date columns of a normalized frame that stayed text because of cells that
+# are not dates
+def text_date_columns(df, date_columns=DEFAULT_DATE_COLUMNS):
+    return [column for column in df.columns
+            if column in date_columns and not pd.api.types.is_datetime64_any_dtype(df[column])]
+
+# Optional row selection on a normalized frame, all vectorized.
+# filters maps a column to the values to keep (dates as 'YYYY-MM-DD'),
+# dedupe drops repeated rows (True) or rows repeating a list of key columns,
+# and sort_by orders the rows by those columns with a stable sort.
+def shape_frame(df, sort_by=None, filters=None, dedupe=False):
+    if filters:
+        keep = np.ones(len(df), dtype=bool)
+        for column, values in filters.items():
+            series = df[column]
+            text = series.dt.strftime('%Y-%m-%d') if pd.api.types.is_datetime64_any_dtype(series) else series.astype(str)
+            keep &= text.isin([str(value) for value in values]).to_numpy(dtype=bool)
+        df = df[keep]
+    if dedupe:
+        df = df.drop_duplicates(subset=None if dedupe is True else list(dedupe))
+    if sort_by:
+        df = df.sort_values(list(sort_by), kind='stable', na_position='last')
+    return df.reset_index(drop=True)
+
+# Convert a frame back to JSON-ready cell values, column by column.
+# Datetimes become date serial numbers (whole days as ints) so they are written
+# as real dates, missing values become empty cells and every value is a plain
+# Python object. Returns a list of column value lists.
+def cell_columns(df):
+    columns = []
+    for column in df.columns:
+        series = df[column]
+        if pd.api.types.is_datetime64_any_dtype(series):
+            serials = ((series - SERIAL_EPOCH) / pd.Timedelta(days=1)).round(9)
+            values = [('' if serial != serial else int(serial) if serial.is_integer() else serial)
+                      for serial in serials.tolist()]
+        else:
+            values = series.astype(object).where(series.notna(), '').tolist()
+        columns.append(values)
+    return columns
+
+# Rows of JSON-ready cell values for a frame (see cell_columns)
+def cell_rows(df):
+    return [list(row) for row in zip(*cell_columns(df))]
+
+# A frame of JSON-ready cell values with the same columns, for comparing with
+# values read back from a sheet
+def cell_frame(df):
+    return pd.DataFrame(dict(zip(df.columns, cell_columns(df))), columns=df.columns)
+
+# repeatCell requests giving the datetime columns of df a date number format.
+# The ranges are open-ended so rows added later get the format as well.
+def compile_date_formats(df, sheet_id):
+    return [{
+        'repeatCell': {
+            'range': {
+                'sheetId': sheet_id,
+                # Row 0 holds the header
+                'startRowIndex': 1,
+                'startColumnIndex': index,
+                'endColumnIndex': index + 1
+            },
+            'cell': {
+                'userEnteredFormat': {
+                    'numberFormat': {'type': 'DATE'}
+                }
+            },
+            'fields': 'userEnteredFormat.numberFormat'
+        }
+    } for index, column in enumerate(df.columns) if pd.api.types.is_datetime64_any_dtype(df[column])]
@@ -0,0 +1,361 @@
+import json
+from contextlib import contextmanager
+
+# Only the standard library is imported at module level. pandas and the Google
+# client libraries are imported inside combine() when a stage needs them, so
+# the GUI and the CLI's --help start without paying for them.
+
+# Default settings, overridden by the config file or combine() arguments.
+# The other modules import their defaults from here so every value is defined once.
+DEFAULT_REQUIRED_COLUMNS = ['Due Date', 'Video topic', 'App Promotion', 'Type', 'Thumbnail Text', 'Live Date', 'Status']
+DEFAULT_DATE_COLUMNS = ['Due Date', 'Live Date']
+# Columns identifying a row when an existing sheet is synced and row_key is
+# not given; rows are matched on every column if any of them is not required
+DEFAULT_ROW_KEY = ['Video topic', 'Due Date']
+DEFAULT_TITLE = 'Combined Sheet Based on Template'
+DEFAULT_SHARE_ROLE = 'reader'
+DEFAULT_SERVICE_ACCOUNT_FILE = 'credentials.json'
+# Number of source spreadsheets downloaded at the same time
+DEFAULT_MAX_WORKERS = 8
+# Rows sent per values().update call when uploading, and upload requests sent at once
+DEFAULT_CHUNK_ROWS = 5000
+DEFAULT_MAX_IN_FLIGHT = 2
+# Sheets API limits are 60 read and 60 write requests per minute per user
+DEFAULT_READS_PER_MINUTE = 60
+DEFAULT_WRITES_PER_MINUTE = 60
+DEFAULT_STATE_FILE = 'combine_state.json'
+DEFAULT_TEMPLATE_CACHE = 'template_cache.json'
+DEFAULT_SOURCE_CACHE_MB = 256
+
+# sheetId given to the only tab of a newly created spreadsheet
+NEW_SHEET_ID = 0
+DEFAULT_OPTIONS = {
+    'template_sheet_id': None,
+    'sheets': [],
+    'required_columns': DEFAULT_REQUIRED_COLUMNS,
+    'title': DEFAULT_TITLE,
+    'share_role': DEFAULT_SHARE_ROLE,
+    'service_account_file': DEFAULT_SERVICE_ACCOUNT_FILE,
+    'max_workers': DEFAULT_MAX_WORKERS,
+    'chunk_rows': DEFAULT_CHUNK_ROWS,
+    'max_in_flight': DEFAULT_MAX_IN_FLIGHT,
+    'reads_per_minute': DEFAULT_READS_PER_MINUTE,
+    'writes_per_minute': DEFAULT_WRITES_PER_MINUTE,
+    'output_spreadsheet_id': None,
+    'row_key': None,
+    'incremental': False,
+    'state_file': DEFAULT_STATE_FILE,
+    'template_cache': DEFAULT_TEMPLATE_CACHE,
+    'source_cache': None,
+    'source_cache_mb': DEFAULT_SOURCE_CACHE_MB,
+    'trace_file': None,
+    'date_columns': DEFAULT_DATE_COLUMNS,
+    'sort_by': None,
+    'filters': None,
+    'dedupe': False
+}
+
+# Fill in defaults for a config dict read from source (used in error messages).
+# Sources are listed under "sheets" as {"url": ..., "gid": ...} objects (gid
+# defaults to 0) and come back as sheet_urls_and_gids tuples.
+def make_options(config, source='config'):
+    unknown = set(config) - set(DEFAULT_OPTIONS)
+    if unknown:
+        raise ValueError(f"Unknown config keys in {source}: {sorted(unknown)}")
+    options = dict(DEFAULT_OPTIONS, **config)
+    options['sheet_urls_and_gids'] = [(sheet['url'], sheet.get('gid', 0)) for sheet in options.pop('sheets')]
+    return options
+
+# Read a JSON config file and fill in defaults
+def load_config(path):
+    with open(path) as f:
+        config = json.load(f)
+    return make_options(config, path)
+
+# Helper function to trace a stage and log how long it took, with the API
+# calls made during it and the counts set on its span
+@contextmanager
+def _stage(log, name, **args):
+    from tracing import span
+    log(f"{name}...")
+    with span(name, **args) as current:
+        yield current
+    log(current.summary())
+
+# Helper function to build the edit URL of a spreadsheet
+def sheet_url(spreadsheet_id):
+    return f"https://docs.google.com/spreadsheets/d/{spreadsheet_id}/edit"
+
+# Helper function running the pipeline for combine(), which passes every argument
+def _combine(sheet_urls_and_gids, required_columns, template_sheet_id, title, share_role, service_account_file,
+             max_workers, chunk_rows, max_in_flight, output_spreadsheet_id, row_key, incremental, state_file,
+             template_cache, source_cache, source_cache_mb, date_columns, sort_by, filters, dedupe, log, progress):
+    from clients import get_sheets_service, get_drive_service
+    from scheduler import execute, CancelledError
+
+    # Incremental runs map each source to its block of rows, so the rows must stay in source order
+    if incremental and (sort_by or filters or dedupe):
+        raise ValueError("sort_by, filters and dedupe can't be combined with incremental runs.")
+    # Incremental runs write to the sheet recorded in state_file, not to a given one
+    if incremental and output_spreadsheet_id is not None:
+        raise ValueError("incremental can't be combined with output_spreadsheet_id.")
+
+    # Options naming columns can only use the columns that are read
+    for name, columns in [('row_key', row_key), ('sort_by', sort_by), ('filters', filters),
+                          ('dedupe', dedupe if not isinstance(dedupe, bool) else None)]:
+        unknown = [column for column in columns or [] if column not in required_columns]
+        if unknown:
+            raise ValueError(f"{name} uses columns that are not in required_columns: {unknown}")
+    if row_key is None and all(column in required_columns for column in DEFAULT_ROW_KEY):
+        row_key = DEFAULT_ROW_KEY
+
+    with _stage(log, "Connecting to Google APIs"):
+        service = get_sheets_service(service_account_file)
+        drive_service = get_drive_service(service_account_file)
+
+    revisions = None
+    if incremental:
+        from combiner import get_spreadsheet_id
+        from incremental import load_state, save_state, get_revisions, refresh_combined_sheet
+
+        with _stage(log, "Refreshing changed sheets"):
+            refreshed = refresh_combined_sheet(service, drive_service, load_state(state_file),
+                                               sheet_urls_and_gids, required_columns, max_workers, chunk_rows,
+                                               date_columns, log)
+        if refreshed is not None:
+            state, changed_urls, errors = refreshed
+            save_state(state_file, state)
+            log(f"{len(changed_urls)} changed sheet(s) refreshed.")
+            return {
+                'spreadsheet_id': state['spreadsheet_id'],
+                'url': sheet_url(state['spreadsheet_id']),
+                'mode': 'refreshed',
+                'changed': changed_urls,
+                'errors': errors
+            }
+
+        # Record the source revisions before reading so changes made during the run are picked up next time
+        revisions = get_revisions(drive_service, [get_spreadsheet_id(url) for url, gid in sheet_urls_and_gids])
+
+    from combiner import fetch_sheets, combine_dataframes, get_template_formatting, compile_hyperlinks, upload_dataframe
+    from normalize import normalize_frame, shape_frame, compile_date_formats
+    from stages import StageGraph
+    from tracing import span
+
+    def sheet_done(url, error):
+        if error is not None and not isinstance(error, CancelledError):
+            log(f"Error processing sheet: {url} - {error}")
+        if progress is not None:
+            progress(url, error)
+
+    # Read data from all sheets concurrently, serving unchanged ones from source_cache if set
+    def read_sheets():
+        with _stage(log, "Reading data from all sheets", sources=len(sheet_urls_and_gids)) as stage:
+            if source_cache:
+                from source_cache import SourceCache, fetch_sheets_cached
+                cache = SourceCache(source_cache, source_cache_mb * 1024 * 1024)
+                try:
+                    results = fetch_sheets_cached(service, drive_service, cache, sheet_urls_and_gids,
+                                                  required_columns, max_workers, sheet_done, revisions, date_columns)
+                finally:
+                    cache.close()
+            else:
+                results = fetch_sheets(service, sheet_urls_and_gids, required_columns, max_workers, sheet_done,
+                                       date_columns)
+            stage.set(rows=sum(len(df) for url, df, error in results if df is not None),
+                      errors=sum(1 for url, df, error in results if error is not None))
+
+        # A cancelled run stops here instead of combining what was read so far
+        for url, df, error in results:
+            if isinstance(error, CancelledError):
+                raise error
+        return results
+
+    def merge(results):
+        dataframes = [df for url, df, error in results if df is not None]
+        if not dataframes:
+            raise ValueError("No valid data found in any sheets.")
+        with _stage(log, "Merging dataframes") as stage:
+            combined_df = combine_dataframes(dataframes)
+            stage.set(rows=len(combined_df), cells=combined_df.size)
+        with _stage(log, "Normalizing data") as stage:
+            combined_df = shape_frame(normalize_frame(combined_df, date_columns), sort_by, filters, dedupe)
+            stage.set(rows=len(combined_df), memory_kb=round(combined_df.memory_usage(deep=True).sum() / 1024))
+        return combined_df
+
+    # Update the existing sheet with only the rows and cells that changed
+    if output_spreadsheet_id is not None:
+        from sheet_diff import sync_combined_sheet
+
+        results = read_sheets()
+        combined_df = merge(results)
+        with _stage(log, "Updating existing sheet") as stage:
+            changes = sync_combined_sheet(service, output_spreadsheet_id, combined_df, 'Sheet1', row_key, chunk_rows)
+            stage.set(**changes)
+        log(f"{changes['inserted']} row(s) inserted, {changes['updated']} updated ({changes['updated_cells']} cells) "
+            f"and {changes['deleted']} deleted.")
+        return {
+            'spreadsheet_id': output_spreadsheet_id,
+            'url': sheet_url(output_spreadsheet_id),
+            'mode': 'synced',
+            'changes': changes,
+            'errors': [(url, error) for url, df, error in results if error is not None]
+        }
+
+    # The new sheet gets a fixed sheetId so the template formatting can be
+    # compiled before the spreadsheet exists
+    def create_sheet():
+        with _stage(log, "Creating new Google Sheet"):
+            spreadsheet_body = {
+                'properties': {
+                    'title': title
+                },
+                'sheets': [
+                    {
+                        'properties': {
+                            'sheetId': NEW_SHEET_ID,
+                            'title': 'Sheet1'
+                        }
+                    }
+                ]
+            }
+            spreadsheet = execute(service.spreadsheets().create(body=spreadsheet_body, fields='spreadsheetId,sheets'))
+            return spreadsheet['spreadsheetId'], spreadsheet['sheets'][0]['properties']['gridProperties']
+
+    # Compiled template formats are reused from template_cache until the template changes
+    def read_template():
+        if not template_sheet_id:
+            return []
+        with _stage(log, "Reading formatting from template sheet") as stage:
+            if template_cache:
+                from template_cache import cached_template_formatting
+                requests = cached_template_formatting(service, drive_service, template_sheet_id, NEW_SHEET_ID,
+                                                      cache_file=template_cache)
+            else:
+                requests = get_template_formatting(service, template_sheet_id, NEW_SHEET_ID)
+            stage.set(requests=len(requests))
+        return requests
+
+    # Upload the data in row chunks, growing the grid first so every chunk lands inside it
+    def upload(created, combined_df):
+        spreadsheet_id, grid = created
+        with _stage(log, "Uploading data to new sheet", rows=len(combined_df), cells=combined_df.size):
+            grid_rows = max(grid['rowCount'], len(combined_df) + 1)
+            grid_columns = max(grid['columnCount'], len(combined_df.columns))
+            if (grid_rows, grid_columns) != (grid['rowCount'], grid['columnCount']):
+                execute(service.spreadsheets().batchUpdate(
+                    spreadsheetId=spreadsheet_id,
+                    body={'requests': [{
+                        'updateSheetProperties': {
+                            'properties': {
+                                'sheetId': NEW_SHEET_ID,
+                                'gridProperties': {'rowCount': grid_rows, 'columnCount': grid_columns}
+                            },
+                            'fields': 'gridProperties(rowCount,columnCount)'
+                        }
+                    }]}
+                ), idempotent=True)
+            upload_dataframe(service, spreadsheet_id, combined_df, 'Sheet1', chunk_rows, max_in_flight)
+        return grid_rows
+
+    # Send the template formats and the hyperlink blocks in a single batch update.
+    # It runs after the upload because writing a value drops the link on its cell.
+    def apply_formatting(created, template_requests, combined_df, uploaded):
+        with _stage(log, "Applying formatting and hyperlinks") as stage:
+            with span('Compiling hyperlinks') as links:
+                link_requests = compile_hyperlinks(combined_df, required_columns, NEW_SHEET_ID)
+                links.set(requests=len(link_requests))
+            requests = template_requests + compile_date_formats(combined_df, NEW_SHEET_ID) + link_requests
+            stage.set(requests=len(requests))
+            # Setting formats and links again leaves the same result, so the request is safe to retry
+            if requests:
+                execute(service.spreadsheets().batchUpdate(
+                    spreadsheetId=created[0],
+                    body={'requests': requests}
+                ), idempotent=True)
+
+    # Share the new sheet with anyone who has the link, once it is fully built
+    def share(created, formatted):
+        if share_role:
+            with _stage(log, "Sharing the new sheet"):
+                execute(drive_service.permissions().create(
+                    fileId=created[0],
+                    body={'type': 'anyone', 'role': share_role}
+                ))
+
+    # Creating the sheet and reading the template do not depend on the source
+    # data, so they run while the sources download. Sharing waits for the
+    # formatting so a half-built sheet is never made public.
+    graph = StageGraph()
+    graph.add('create', create_sheet)
+    graph.add('template', read_template)
+    graph.add('read', read_sheets)
+    graph.add('merge', merge, ['read'])
+    graph.add('upload', upload, ['create', 'merge'])
+    graph.add('format', apply_formatting, ['create', 'template', 'merge', 'upload'])
+    graph.add('share', share, ['create', 'format'])
+    try:
+        results = graph.run()
+    except Exception:
+        # Don't leave an unfinished spreadsheet behind when the run fails after
+        # creating it. The delete is sent even when the run was cancelled.
+        if 'create' in graph.results:
+            try:
+                execute(drive_service.files().delete(fileId=graph.results['create'][0]), cancellable=False)
+            except Exception as e:
+                log(f"Could not remove the unfinished sheet: {e}")
+        raise
+    spreadsheet_id = results['create'][0]
+
+    # Remember the new sheet and the source revisions for the next incremental run
+    if incremental:
+        from incremental import save_state, build_state
+        from normalize import text_date_columns
+        save_state(state_file, build_state(spreadsheet_id, NEW_SHEET_ID, 'Sheet1', results['upload'], sheet_urls_and_gids,
+                                           required_columns, revisions, [df for url, df, error in results['read']],
+                                           date_columns, text_date_columns(results['merge'], date_columns)))
+
+    return {
+        'spreadsheet_id': spreadsheet_id,
+        'url': sheet_url(spreadsheet_id),
+        'mode': 'created',
+        'errors': [(url, error) for url, df, error in results['read'] if error is not None]
+    }
+
+# Combine the source sheets into one Google Sheet.
+# By default a new spreadsheet is created, filled, formatted from the template
+# and shared; creating the sheet and reading the template overlap with the
+# source downloads (see StageGraph). Template formats are cached in
+# template_cache (None reads the template every run). With source_cache set to
+# a file path, tabs whose spreadsheet has the same Drive modifiedTime as when
+# they were cached are read from that file (see SourceCache). With
+# output_spreadsheet_id the existing sheet is updated through a row-level diff
+# matching rows on row_key (DEFAULT_ROW_KEY when not given) instead, and with incremental=True only the sources changed since the run
+# recorded in state_file are rewritten. log receives progress messages and
+# progress(url, error) is called as each source finishes.
+# The merged rows get typed columns (date_columns as datetimes, see
+# normalize_frame) and can be filtered, deduplicated and sorted (see
+# shape_frame) before they are written.
+# Every stage is traced (see tracing.span) and its timing, API calls and
+# row counts are logged; with trace_file the whole trace is also written as
+# JSON lines (.jsonl) or as a Chrome trace file (any other extension).
+# Returns a dict with the spreadsheet ID, its URL, the mode used and the
+# per-source errors.
+def combine(sheet_urls_and_gids, required_columns=DEFAULT_REQUIRED_COLUMNS, template_sheet_id=None, *,
+            title=DEFAULT_TITLE, share_role=DEFAULT_SHARE_ROLE, service_account_file=DEFAULT_SERVICE_ACCOUNT_FILE,
+            max_workers=DEFAULT_MAX_WORKERS, chunk_rows=DEFAULT_CHUNK_ROWS, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+            output_spreadsheet_id=None, row_key=None, incremental=False, state_file=DEFAULT_STATE_FILE,
+            template_cache=DEFAULT_TEMPLATE_CACHE, source_cache=None, source_cache_mb=DEFAULT_SOURCE_CACHE_MB,
+            date_columns=DEFAULT_DATE_COLUMNS, sort_by=None, filters=None, dedupe=False, trace_file=None, log=print,
+            progress=None):
+    options = dict(locals())
+    del options['trace_file']
+    from tracing import start_trace, stop_trace
+
+    tracer = start_trace()
+    try:
+        return _combine(**options)
+    finally:
+        stop_trace()
+        if trace_file:
+            tracer.write(trace_file)
@@ -0,0 +1,247 @@
+import email.utils
+import random
+import socket
+import threading
+import time
+
+import tracing
+from pipeline import DEFAULT_READS_PER_MINUTE, DEFAULT_WRITES_PER_MINUTE
+
+# Retry settings for quota and transient server errors
+DEFAULT_MAX_RETRIES = 6
+DEFAULT_BASE_DELAY = 1.0
+DEFAULT_MAX_DELAY = 64.0
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+# Writes that give the same result when sent twice. Other writes, such as
+# creating a spreadsheet or a batchUpdate that deletes rows, may already have
+# been applied when a server error or timeout comes back, so they are only
+# retried on 429, which means the request was rejected.
+IDEMPOTENT_METHODS = (
+    'sheets.spreadsheets.values.update',
+    'sheets.spreadsheets.values.batchUpdate',
+    'sheets.spreadsheets.values.clear',
+    'drive.files.delete'
+)
+
+# Raised for requests made after the shared scheduler was cancelled
+class CancelledError(Exception):
+    pass
+
+# Token bucket refilled at rate tokens per second up to capacity.
+# acquire() blocks until enough tokens are available; hold() stops the refill
+# for a while so every thread backs off together after a quota error.
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        if now > self._updated:
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    def acquire(self, tokens=1):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= tokens and now >= self._updated:
+                    self._tokens -= tokens
+                    return
+                wait = max(self._updated - now, (tokens - self._tokens) / self.rate)
+            time.sleep(wait)
+
+    def hold(self, seconds):
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens = 0
+            self._updated = max(self._updated, now + seconds)
+
+# Token bucket kept in shared memory.
+# Processes started with the bucket (e.g. passed in a pool initializer) all
+# draw from the same budget. time.monotonic() is system-wide, so the refill
+# time means the same thing in every process.
+class SharedTokenBucket(TokenBucket):
+    def __init__(self, rate, capacity, context=None):
+        import multiprocessing
+        context = context or multiprocessing
+        self.rate = rate
+        self.capacity = capacity
+        self._state = context.RawArray('d', [capacity, time.monotonic()])
+        self._lock = context.Lock()
+
+    @property
+    def _tokens(self):
+        return self._state[0]
+
+    @_tokens.setter
+    def _tokens(self, value):
+        self._state[0] = value
+
+    @property
+    def _updated(self):
+        return self._state[1]
+
+    @_updated.setter
+    def _updated(self, value):
+        self._state[1] = value
+
+# Helper function to read a Retry-After header as seconds
+def _retry_after(error):
+    resp = getattr(error, 'resp', None)
+    value = resp.get('retry-after') if resp is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+# Helper function to get the HTTP status of a failed call, if it has one.
+# googleapiclient is imported here so importing this module stays cheap.
+def _http_status(error):
+    from googleapiclient.errors import HttpError
+    if isinstance(error, HttpError):
+        return error.resp.status
+    return None
+
+# Helper function to tell whether a failed call is worth retrying
+def _is_retryable(error, idempotent=True):
+    status = _http_status(error)
+    if not idempotent:
+        return status == 429
+    if status is not None:
+        return status in RETRYABLE_STATUSES
+    return isinstance(error, (ConnectionError, TimeoutError, socket.timeout))
+
+# Shared gate for every Google API call.
+# Reads (GET) and writes (everything else) draw from separate token buckets
+# sized to the per-minute quotas. Quota and transient errors are retried with
+# jittered exponential backoff, waiting at least as long as Retry-After asks;
+# writes are retried on transient errors only when they are idempotent (reads,
+# IDEMPOTENT_METHODS or idempotent=True), and otherwise only on 429.
+# Once cancel() is called no new request is sent and pending retries stop;
+# requests executed with cancellable=False (cleanup after a cancelled run) are
+# still sent.
+# buckets replaces the token buckets, e.g. with SharedTokenBucket objects from
+# shared_buckets() so several processes share one quota.
+class RequestScheduler:
+    def __init__(self, reads_per_minute=DEFAULT_READS_PER_MINUTE, writes_per_minute=DEFAULT_WRITES_PER_MINUTE,
+                 max_retries=DEFAULT_MAX_RETRIES, base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY,
+                 buckets=None):
+        self.buckets = buckets or {
+            'read': TokenBucket(reads_per_minute / 60.0, reads_per_minute),
+            'write': TokenBucket(writes_per_minute / 60.0, writes_per_minute)
+        }
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def _check_cancelled(self):
+        if self.cancelled.is_set():
+            raise CancelledError("Request cancelled")
+
+    def execute(self, request, kind=None, cancellable=True, idempotent=None):
+        if kind is None:
+            kind = 'read' if getattr(request, 'method', 'GET') == 'GET' else 'write'
+        if idempotent is None:
+            idempotent = kind == 'read' or getattr(request, 'methodId', None) in IDEMPOTENT_METHODS
+        bucket = self.buckets[kind]
+        _count_response_bytes(request)
+        check_cancelled = self._check_cancelled if cancellable else lambda: None
+
+        start = time.perf_counter()
+        quota_wait = 0.0
+        attempt = 0
+        while True:
+            check_cancelled()
+            waited = time.perf_counter()
+            bucket.acquire()
+            quota_wait += time.perf_counter() - waited
+            check_cancelled()
+            try:
+                result = request.execute()
+            except Exception as e:
+                if attempt >= self.max_retries or not _is_retryable(e, idempotent):
+                    _record(request, kind, start, attempt, quota_wait, None, e)
+                    raise
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                retry_after = _retry_after(e)
+                if retry_after is not None:
+                    delay = max(delay, retry_after)
+                if _http_status(e) == 429:
+                    bucket.hold(delay)
+                    quota_wait += delay
+                attempt += 1
+                if not cancellable:
+                    time.sleep(delay)
+                elif self.cancelled.wait(delay):
+                    raise CancelledError("Request cancelled")
+            else:
+                _record(request, kind, start, attempt, quota_wait, result)
+                return result
+
+# Helper function to have a googleapiclient request remember the size of the
+# raw response body it parses, so tracing never has to re-encode a response
+def _count_response_bytes(request):
+    postproc = getattr(request, 'postproc', None)
+    if postproc is None or hasattr(request, 'response_bytes'):
+        return
+    request.response_bytes = 0
+
+    def counting_postproc(resp, content):
+        request.response_bytes = len(content or b'')
+        return postproc(resp, content)
+    request.postproc = counting_postproc
+
+# Helper function to report a finished call to the active trace, if any
+def _record(request, kind, start, retries, quota_wait, result, error=None):
+    if not tracing.is_tracing():
+        return
+    body = getattr(request, 'body', None) or ''
+    request_bytes = len(getattr(request, 'uri', '') or '') + len(body)
+    response_bytes = getattr(request, 'response_bytes', 0)
+    method = getattr(request, 'methodId', None) or kind
+    tracing.record_call(method, start, time.perf_counter(), request_bytes, response_bytes, retries, quota_wait,
+                        f'{type(error).__name__}: {error}' if error is not None else None)
+
+# Read and write buckets in shared memory for schedulers in several processes
+def shared_buckets(reads_per_minute=DEFAULT_READS_PER_MINUTE, writes_per_minute=DEFAULT_WRITES_PER_MINUTE, context=None):
+    return {
+        'read': SharedTokenBucket(reads_per_minute / 60.0, reads_per_minute, context),
+        'write': SharedTokenBucket(writes_per_minute / 60.0, writes_per_minute, context)
+    }
+
+# Scheduler shared by every caller in the process
+_scheduler = RequestScheduler()
+
+# Replace the shared scheduler, e.g. to change the quota or retry settings
+def configure_scheduler(**settings):
+    global _scheduler
+    _scheduler = RequestScheduler(**settings)
+    return _scheduler
+
+# Stop all outstanding requests of the shared scheduler
+def cancel_requests():
+    _scheduler.cancel()
+
+# Allow requests again after cancel_requests()
+def reset_cancel():
+    _scheduler.cancelled.clear()
+
+# Run a googleapiclient request through the shared scheduler
+def execute(request, kind=None, cancellable=True, idempotent=None):
+    return _scheduler.execute(request, kind, cancellable, idempotent)
@@ -0,0 +1,208 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+from scheduler import execute
+from combiner import (column_letter, quote_sheet_title, find_row_runs, compile_hyperlinks, upload_dataframe,
+                      DEFAULT_CHUNK_ROWS, MAX_CHUNK_BYTES)
+from normalize import cell_frame, compile_date_formats
+
+# Helper function to index rows by key.
+# Each row is keyed by a hash of its key columns plus its occurrence number, so
+# rows with duplicate keys pair up in order.
+def _row_index(df, key_columns):
+    hashes = pd.util.hash_pandas_object(df[key_columns], index=False).to_numpy()
+    occurrence = pd.Series(hashes).groupby(hashes).cumcount().to_numpy()
+    return pd.DataFrame({'hash': hashes, 'occurrence': occurrence, 'position': np.arange(len(df))})
+
+# Diff the rows of an existing sheet (old) against a new combined frame.
+# Rows are matched through a hash index of key_columns, or of the whole row when
+# no key is given. Returns the matched (old, new) positions in sheet order, a
+# boolean matrix of the cells that differ in each matched pair, and the old
+# positions to delete and new positions to insert.
+def diff_frames(old, new, key_columns=None):
+    key_columns = list(key_columns or new.columns)
+    old = old.astype(str)
+    new = new[old.columns].astype(str)
+
+    merged = _row_index(old, key_columns).merge(
+        _row_index(new, key_columns),
+        on=['hash', 'occurrence'],
+        how='outer',
+        suffixes=('_old', '_new'),
+        indicator=True
+    )
+    matched = merged[merged['_merge'] == 'both'].sort_values('position_old')
+    old_positions = matched['position_old'].to_numpy(dtype=int)
+    new_positions = matched['position_new'].to_numpy(dtype=int)
+    deletes = np.sort(merged.loc[merged['_merge'] == 'left_only', 'position_old'].to_numpy(dtype=int))
+    inserts = np.sort(merged.loc[merged['_merge'] == 'right_only', 'position_new'].to_numpy(dtype=int))
+
+    changed = old.to_numpy()[old_positions] != new.to_numpy()[new_positions]
+    return old_positions, new_positions, changed, deletes, inserts
+
+# Helper function to group sorted positions into contiguous (start, end) ranges
+def _ranges(positions):
+    ranges = []
+    for position in positions.tolist():
+        if ranges and ranges[-1][1] == position:
+            ranges[-1][1] = position + 1
+        else:
+            ranges.append([position, position + 1])
+    return ranges
+
+# Helper function to send value ranges through values().batchUpdate,
+# starting a new request whenever the body would pass MAX_CHUNK_BYTES
+def _batch_write(service, spreadsheet_id, data):
+    batch = []
+    size = 0
+    for value_range in data:
+        value_size = len(json.dumps(value_range))
+        if batch and size + value_size > MAX_CHUNK_BYTES:
+            execute(service.spreadsheets().values().batchUpdate(
+                spreadsheetId=spreadsheet_id,
+                body={'valueInputOption': 'RAW', 'data': batch}
+            ))
+            batch = []
+            size = 0
+        batch.append(value_range)
+        size += value_size
+    if batch:
+        execute(service.spreadsheets().values().batchUpdate(
+            spreadsheetId=spreadsheet_id,
+            body={'valueInputOption': 'RAW', 'data': batch}
+        ))
+
+# Bring an existing combined sheet in line with combined_df using minimal writes.
+# The current contents are read once and diffed row by row (see diff_frames).
+# Deleted rows are removed with deleteDimension, rows present on both sides
+# get only their changed cells rewritten through one values().batchUpdate, and
+# new rows are appended after the kept ones. Matched rows never move, so manual
+# edits in other columns stay with their row. If the header no longer matches,
+# the whole sheet is rewritten. Returns counts of inserted, updated and deleted
+# rows and of updated cells.
+def sync_combined_sheet(service, spreadsheet_id, combined_df, sheet_title='Sheet1', key_columns=None,
+                        chunk_rows=DEFAULT_CHUNK_ROWS):
+    columns = combined_df.columns.tolist()
+    quoted_title = quote_sheet_title(sheet_title)
+    last_letter = column_letter(len(columns) - 1)
+
+    metadata = execute(service.spreadsheets().get(
+        spreadsheetId=spreadsheet_id,
+        fields='sheets.properties(sheetId,title,gridProperties.rowCount)'
+    ))
+    matches = [s['properties'] for s in metadata.get('sheets', []) if s['properties']['title'] == sheet_title]
+    if not matches:
+        raise ValueError(f"No tab named {sheet_title} in spreadsheet {spreadsheet_id}")
+    properties = matches[0]
+    sheet_id = properties['sheetId']
+    grid_rows = properties['gridProperties']['rowCount']
+
+    data = execute(service.spreadsheets().values().get(
+        spreadsheetId=spreadsheet_id,
+        range=f'{quoted_title}!A1:{last_letter}',
+        valueRenderOption='UNFORMATTED_VALUE',
+        dateTimeRenderOption='SERIAL_NUMBER'
+    ))
+    rows = [row + [''] * (len(columns) - len(row)) for row in data.get('values', [])]
+    header = rows[0] if rows else []
+    old = pd.DataFrame(rows[1:], columns=columns)
+
+    # Compare stored cell values on both sides, with dates as serial numbers
+    new_cells = cell_frame(combined_df)
+
+    structure = []
+    if header != columns:
+        deletes = np.arange(len(old))
+        kept_rows = 0
+        inserts = np.arange(len(combined_df))
+        updates = []
+    else:
+        old_positions, new_positions, changed, deletes, inserts = diff_frames(old, new_cells, key_columns)
+        kept_rows = len(old) - len(deletes)
+
+        # Row of every kept old row once the deleted rows are gone
+        sheet_rows = old_positions - np.searchsorted(deletes, old_positions)
+        updates = []
+        new_values = new_cells.to_numpy()
+        for i, start, end in find_row_runs(changed):
+            row = int(sheet_rows[i])
+            values = new_values[new_positions[i], start:end].tolist()
+            update = updates[-1] if updates else None
+            if update and update['end_row'] == row and update['start'] == start and update['end'] == end:
+                update['values'].append(values)
+                update['end_row'] = row + 1
+            else:
+                updates.append({'start_row': row, 'end_row': row + 1, 'start': start, 'end': end,
+                                'values': [values], 'positions': []})
+            updates[-1]['positions'].append(int(new_positions[i]))
+
+        # Delete from the bottom up so earlier indexes stay valid within the batch
+        for start, end in reversed(_ranges(deletes)):
+            structure.append({
+                'deleteDimension': {
+                    'range': {
+                        'sheetId': sheet_id,
+                        'dimension': 'ROWS',
+                        # Row 0 holds the header
+                        'startIndex': start + 1,
+                        'endIndex': end + 1
+                    }
+                }
+            })
+        grid_rows -= len(deletes)
+
+    needed_rows = kept_rows + len(inserts) + 1
+    if needed_rows > grid_rows:
+        structure.append({
+            'appendDimension': {
+                'sheetId': sheet_id,
+                'dimension': 'ROWS',
+                'length': needed_rows - grid_rows
+            }
+        })
+    if structure:
+        execute(service.spreadsheets().batchUpdate(
+            spreadsheetId=spreadsheet_id,
+            body={'requests': structure}
+        ))
+
+    _batch_write(service, spreadsheet_id, [{
+        'range': f"{quoted_title}!{column_letter(update['start'])}{update['start_row'] + 2}"
+                 f":{column_letter(update['end'] - 1)}{update['end_row'] + 1}",
+        'values': update['values']
+    } for update in updates])
+
+    inserted_df = combined_df.iloc[inserts]
+    if header != columns:
+        upload_dataframe(service, spreadsheet_id, inserted_df, sheet_title, chunk_rows)
+        if len(old) > len(inserted_df):
+            execute(service.spreadsheets().values().clear(
+                spreadsheetId=spreadsheet_id,
+                range=f'{quoted_title}!A{len(inserted_df) + 2}:{last_letter}{len(old) + 1}',
+                body={}
+            ))
+    elif len(inserted_df):
+        upload_dataframe(service, spreadsheet_id, inserted_df, sheet_title, chunk_rows, start_row=kept_rows, header=False)
+
+    # Re-link the rewritten rows; writing a value drops the old link formatting
+    requests = compile_hyperlinks(inserted_df, columns, sheet_id, start_row=kept_rows)
+    for update in updates:
+        requests += compile_hyperlinks(combined_df.iloc[update['positions']], columns, sheet_id,
+                                       rows=range(update['start_row'], update['end_row']))
+    # Make sure the rewritten date cells show as dates
+    if requests or updates or len(inserted_df):
+        requests += compile_date_formats(combined_df, sheet_id)
+    if requests:
+        execute(service.spreadsheets().batchUpdate(
+            spreadsheetId=spreadsheet_id,
+            body={'requests': requests}
+        ), idempotent=True)
+
+    return {
+        'inserted': len(inserts),
+        'updated': len(set(position for update in updates for position in update['positions'])),
+        'deleted': len(deletes),
+        'updated_cells': sum(len(update['values']) * (update['end'] - update['start']) for update in updates)
+    }
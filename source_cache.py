@@ -0,0 +1,126 @@
+import json
+import sqlite3
+import time
+import zlib
+
+import pandas as pd
+
+from scheduler import execute, CancelledError
+from combiner import get_spreadsheet_id, fetch_sheets, DEFAULT_MAX_WORKERS
+from pipeline import DEFAULT_SOURCE_CACHE_MB, DEFAULT_DATE_COLUMNS
+
+# Helper function to build the columns key of an entry; date columns are read
+# unformatted and the others as shown, so both lists are part of the key
+def _columns_key(columns, date_columns):
+    return json.dumps([list(columns), [column for column in columns if column in date_columns]])
+
+# Local cache of fetched source tabs in a SQLite file.
+# Each entry is one frame keyed by spreadsheet ID, gid and the Drive
+# modifiedTime it was read at, together with the columns that were requested
+# and which of them were read as dates.
+# Frames are stored column by column as zlib-compressed JSON, and reads go
+# through SQLite's memory map. Entries carry a last-used time; once the
+# cache grows past max_bytes, the least recently used entries are evicted.
+class SourceCache:
+    def __init__(self, path, max_bytes=DEFAULT_SOURCE_CACHE_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.connection = sqlite3.connect(path, timeout=30)
+        self.connection.execute(f'PRAGMA mmap_size = {int(max_bytes)}')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS frames (
+                spreadsheet_id TEXT NOT NULL,
+                gid INTEGER NOT NULL,
+                modified_time TEXT NOT NULL,
+                columns TEXT NOT NULL,
+                data BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (spreadsheet_id, gid)
+            )
+        ''')
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    # Return the cached frame of a tab, or None unless one was stored for this
+    # modifiedTime, these columns and these date columns
+    def get(self, spreadsheet_id, gid, modified_time, columns, date_columns=DEFAULT_DATE_COLUMNS):
+        row = self.connection.execute(
+            'SELECT data FROM frames WHERE spreadsheet_id = ? AND gid = ? AND modified_time = ? AND columns = ?',
+            (spreadsheet_id, gid, modified_time, _columns_key(columns, date_columns))
+        ).fetchone()
+        if row is None:
+            return None
+        with self.connection:
+            self.connection.execute('UPDATE frames SET last_used = ? WHERE spreadsheet_id = ? AND gid = ?',
+                                    (time.time(), spreadsheet_id, gid))
+        data = json.loads(zlib.decompress(row[0]))
+        return pd.DataFrame(dict(zip(columns, data)), columns=list(columns))
+
+    # Store a frame, replacing the older revision of the same tab, then evict
+    # least recently used entries until the cache fits in max_bytes
+    def put(self, spreadsheet_id, gid, modified_time, df, date_columns=DEFAULT_DATE_COLUMNS):
+        data = zlib.compress(json.dumps([df[column].tolist() for column in df.columns]).encode())
+        if len(data) > self.max_bytes:
+            return
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO frames VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (spreadsheet_id, gid, modified_time, _columns_key(df.columns, date_columns), data, len(data), time.time())
+            )
+            total = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM frames').fetchone()[0]
+            for key_id, key_gid, size in self.connection.execute(
+                    'SELECT spreadsheet_id, gid, size FROM frames ORDER BY last_used').fetchall():
+                if total <= self.max_bytes:
+                    break
+                self.connection.execute('DELETE FROM frames WHERE spreadsheet_id = ? AND gid = ?', (key_id, key_gid))
+                total -= size
+
+# Fetch sources like fetch_sheets, serving tabs whose spreadsheet has not been
+# modified since they were cached from disk. The Drive modifiedTime of every
+# spreadsheet is looked up first (or taken from revisions), only the missing
+# tabs go to the Sheets API, and they are cached for the next run.
+def fetch_sheets_cached(service, drive_service, cache, sheet_urls_and_gids, required_columns,
+                        max_workers=DEFAULT_MAX_WORKERS, progress=None, revisions=None, date_columns=DEFAULT_DATE_COLUMNS):
+    spreadsheet_ids = {}
+    for url, gid in sheet_urls_and_gids:
+        try:
+            spreadsheet_ids[url] = get_spreadsheet_id(url)
+        except ValueError:
+            pass
+    if revisions is None:
+        revisions = {}
+        for spreadsheet_id in dict.fromkeys(spreadsheet_ids.values()):
+            # A spreadsheet whose revision can't be read is fetched, and fails, like any other
+            try:
+                revisions[spreadsheet_id] = execute(drive_service.files().get(fileId=spreadsheet_id, fields='modifiedTime'))
+            except CancelledError:
+                raise
+            except Exception:
+                pass
+
+    cached = {}
+    missing = []
+    for index, (url, gid) in enumerate(sheet_urls_and_gids):
+        spreadsheet_id = spreadsheet_ids.get(url)
+        modified_time = revisions.get(spreadsheet_id, {}).get('modifiedTime')
+        df = cache.get(spreadsheet_id, gid, modified_time, required_columns, date_columns) if modified_time else None
+        if df is not None:
+            cached[index] = df
+            if progress is not None:
+                progress(url, None)
+        else:
+            missing.append(index)
+
+    fetched = fetch_sheets(service, [sheet_urls_and_gids[index] for index in missing], required_columns,
+                           max_workers, progress, date_columns)
+    results = dict(zip(missing, fetched))
+    for index, (url, df, error) in results.items():
+        spreadsheet_id = spreadsheet_ids.get(url)
+        modified_time = revisions.get(spreadsheet_id, {}).get('modifiedTime')
+        if error is None and modified_time:
+            cache.put(spreadsheet_id, sheet_urls_and_gids[index][1], modified_time, df, date_columns)
+    for index, df in cached.items():
+        results[index] = (sheet_urls_and_gids[index][0], df, None)
+    return [results[index] for index in range(len(sheet_urls_and_gids))]
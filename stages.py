@@ -0,0 +1,50 @@
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# A small dependency graph of pipeline stages.
+# Each stage is a function called with the results of the stages it depends
+# on, in order. run() starts every stage as soon as its dependencies have
+# finished, so independent stages overlap and the total time follows the
+# critical path instead of the sum of all stages. If a stage fails no new stage
+# is started, the running ones are allowed to finish and the first error is
+# raised; results holds whatever finished before that. Each stage runs in a
+# copy of the caller's context, so context variables such as the active trace
+# reach it.
+class StageGraph:
+    def __init__(self):
+        self.stages = {}
+        self.results = {}
+
+    def add(self, name, function, depends_on=()):
+        for dependency in depends_on:
+            if dependency not in self.stages:
+                raise ValueError(f"Stage {name} depends on unknown stage {dependency}")
+        self.stages[name] = (function, tuple(depends_on))
+
+    def run(self, max_workers=None):
+        pending = dict(self.stages)
+        running = {}
+        error = None
+        with ThreadPoolExecutor(max_workers=max_workers or max(1, len(pending))) as executor:
+            while running or (pending and error is None):
+                if error is None:
+                    for name, (function, depends_on) in list(pending.items()):
+                        if all(dependency in self.results for dependency in depends_on):
+                            args = [self.results[dependency] for dependency in depends_on]
+                            running[executor.submit(contextvars.copy_context().run, function, *args)] = name
+                            del pending[name]
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        self.results[name] = future.result()
+                    except Exception as e:
+                        if error is None:
+                            error = e
+
+        if error is not None:
+            raise error
+        return self.results
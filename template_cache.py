@@ -0,0 +1,56 @@
+import json
+import os
+
+from scheduler import execute
+from combiner import get_template_formatting
+from pipeline import DEFAULT_TEMPLATE_CACHE
+
+# Bump when the layout of the cache file changes so old files are ignored
+CACHE_VERSION = 1
+
+# Helper function to load the cache file, or an empty cache if there is no usable one
+def _load_cache(path):
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {'cache_version': CACHE_VERSION, 'templates': {}}
+    if cache.get('cache_version') != CACHE_VERSION:
+        return {'cache_version': CACHE_VERSION, 'templates': {}}
+    return cache
+
+# Helper function to write the cache file atomically. The temporary file is
+# per process because batch workers may save the same cache at once.
+def _save_cache(path, cache):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, path)
+
+# Helper function to point compiled requests at another sheetId
+def _with_sheet_id(requests, sheet_id):
+    for request in requests:
+        request['repeatCell']['range']['sheetId'] = sheet_id
+    return requests
+
+# Get the compiled formatting requests of a template, reading the template only
+# when it changed. Compiled requests are stored in cache_file under the template
+# ID together with the Drive version they were built from; a run whose template
+# still has that version costs one files.get instead of a grid read.
+def cached_template_formatting(service, drive_service, template_sheet_id, sheet_id, sheet_title='Sheet1',
+                               cache_file=DEFAULT_TEMPLATE_CACHE):
+    revision = execute(drive_service.files().get(fileId=template_sheet_id, fields='modifiedTime,version'))
+    cache = _load_cache(cache_file)
+    entry = cache['templates'].get(template_sheet_id)
+    if entry is not None and entry['version'] == revision.get('version') and entry['sheet_title'] == sheet_title:
+        return _with_sheet_id(entry['requests'], sheet_id)
+
+    requests = get_template_formatting(service, template_sheet_id, sheet_id, sheet_title)
+    cache['templates'][template_sheet_id] = {
+        'version': revision.get('version'),
+        'modified_time': revision.get('modifiedTime'),
+        'sheet_title': sheet_title,
+        'requests': requests
+    }
+    _save_cache(cache_file, cache)
+    return requests
@@ -0,0 +1,187 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Structured tracing of pipeline stages and API calls.
+# A span covers one stage (or a piece of one, like a single source fetch) and
+# counts the API calls made inside it: calls, retries, bytes sent and received
+# and time spent waiting for quota. Calls are attributed to the innermost open
+# span of the calling thread and counted in all its ancestors; worker threads
+# pass the submitting thread's span as parent so their calls roll up into the
+# stage that started them. Nothing is recorded unless a trace is active.
+# The active tracer is a context variable, so concurrent runs in different
+# threads each record into their own trace; a span keeps the tracer it was
+# opened under and passes it on to child spans, so worker threads given a
+# parent span record into the same trace.
+
+_local = threading.local()
+_tracer = contextvars.ContextVar('tracer', default=None)
+
+class Span:
+    def __init__(self, name, parent=None, **args):
+        self.name = name
+        self.parent = parent
+        self.tracer = parent.tracer if parent is not None else _tracer.get()
+        self.args = args
+        self.thread = threading.get_ident()
+        self.start = time.perf_counter()
+        self.end = None
+        self.calls = 0
+        self.retries = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.quota_wait = 0.0
+
+    # Attach counts such as rows or cells to the span
+    def set(self, **args):
+        self.args.update(args)
+
+    @property
+    def seconds(self):
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    # One line describing the span, as shown in the CLI and GUI logs
+    def summary(self):
+        text = f"{self.name} took {self.seconds:.2f}s"
+        if self.calls:
+            text += (f" ({self.calls} API call(s), {self.retries} retries, {self.request_bytes / 1024:.1f} KB sent, "
+                     f"{self.response_bytes / 1024:.1f} KB received, {self.quota_wait:.2f}s waiting for quota)")
+        if self.args:
+            text += ' [' + ', '.join(f'{key}={value}' for key, value in self.args.items()) + ']'
+        return text
+
+    def to_dict(self, origin):
+        return {
+            'type': 'span',
+            'name': self.name,
+            'parent': self.parent.name if self.parent is not None else None,
+            'thread': self.thread,
+            'start': round(self.start - origin, 6),
+            'seconds': round(self.seconds, 6),
+            'calls': self.calls,
+            'retries': self.retries,
+            'request_bytes': self.request_bytes,
+            'response_bytes': self.response_bytes,
+            'quota_wait': round(self.quota_wait, 6),
+            'args': self.args
+        }
+
+# Collects the spans and API calls of one run and writes them out
+class Tracer:
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.spans = []
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def add_span(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def add_call(self, span, call):
+        with self._lock:
+            self.calls.append(call)
+            while span is not None:
+                span.calls += 1
+                span.retries += call['retries']
+                span.request_bytes += call['request_bytes']
+                span.response_bytes += call['response_bytes']
+                span.quota_wait += call['quota_wait']
+                span = span.parent
+
+    # Write the trace as JSON lines (.jsonl) or as a Chrome trace file that
+    # chrome://tracing and Perfetto can open (any other extension)
+    def write(self, path):
+        with self._lock:
+            spans = [span.to_dict(self.origin) for span in self.spans]
+            calls = list(self.calls)
+        with open(path, 'w') as f:
+            if path.endswith('.jsonl'):
+                for record in spans + calls:
+                    f.write(json.dumps(record, default=str) + '\n')
+                return
+
+            events = []
+            for record in spans:
+                events.append({
+                    'name': record['name'], 'cat': 'stage', 'ph': 'X', 'pid': os.getpid(), 'tid': record['thread'],
+                    'ts': int(record['start'] * 1e6), 'dur': int(record['seconds'] * 1e6),
+                    'args': dict({key: value for key, value in record.items()
+                                  if key not in ('type', 'name', 'thread', 'start', 'seconds', 'args')}, **record['args'])
+                })
+            for call in calls:
+                events.append({
+                    'name': call['method'], 'cat': 'api', 'ph': 'X', 'pid': os.getpid(), 'tid': call['thread'],
+                    'ts': int(call['start'] * 1e6), 'dur': int(call['seconds'] * 1e6),
+                    'args': {key: value for key, value in call.items()
+                             if key not in ('type', 'method', 'thread', 'start', 'seconds')}
+                })
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, default=str)
+
+# Start recording spans and calls in the current context
+def start_trace():
+    tracer = Tracer()
+    _tracer.set(tracer)
+    return tracer
+
+# Stop recording in the current context and return the finished tracer
+def stop_trace():
+    tracer = _tracer.get()
+    _tracer.set(None)
+    return tracer
+
+# Innermost open span of the calling thread, to pass as parent to worker threads
+def current_span():
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else None
+
+# Helper function to get the tracer calls of the calling thread go to: the one
+# of its current span, else the one of its context
+def _active_tracer():
+    current = current_span()
+    return current.tracer if current is not None else _tracer.get()
+
+def is_tracing():
+    return _active_tracer() is not None
+
+# Open a span for the duration of the block. parent defaults to the calling
+# thread's current span. The span is yielded so the block can set() counts.
+@contextmanager
+def span(name, parent=None, **args):
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    current = Span(name, parent if parent is not None else current_span(), **args)
+    stack.append(current)
+    try:
+        yield current
+    finally:
+        current.end = time.perf_counter()
+        stack.pop()
+        if current.tracer is not None:
+            current.tracer.add_span(current)
+
+# Record one API call made by the calling thread.
+# start and end are time.perf_counter() values; quota_wait is the time spent
+# waiting for the rate limiter.
+def record_call(method, start, end, request_bytes, response_bytes, retries=0, quota_wait=0.0, error=None):
+    tracer = _active_tracer()
+    if tracer is None:
+        return
+    current = current_span()
+    tracer.add_call(current, {
+        'type': 'call',
+        'method': method,
+        'span': current.name if current is not None else None,
+        'thread': threading.get_ident(),
+        'start': round(start - tracer.origin, 6),
+        'seconds': round(end - start, 6),
+        'request_bytes': request_bytes,
+        'response_bytes': response_bytes,
+        'retries': retries,
+        'quota_wait': round(quota_wait, 6),
+        'error': error
+    })